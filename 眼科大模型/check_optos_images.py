@@ -5,12 +5,16 @@
 如果没有，则从数据集中删除该患者
 """
 import os
+import functools
 import shutil
 from pathlib import Path
 import pandas as pd
 from datetime import datetime, timedelta
 import re
 
+# 欧堡文件夹关键词：同时支持"欧堡"、"欧宝"（早期错别字）和英文"optos"
+OB_FOLDER_RE = re.compile(r'欧堡|欧宝|optos', re.IGNORECASE)
+
 def parse_path_info(path_str):
     """
     解析路径字符串，提取患者ID、姓名和日期
@@ -33,6 +37,21 @@ def parse_path_info(path_str):
     
     return patient_folder, exam_date
 
+@functools.lru_cache(maxsize=4096)
+def list_dir_entries(dir_str):
+    """
+    列出目录下的子项，返回 ((名称, 是否为目录), ...)，按路径缓存结果
+
+    同一患者往往有多条检查记录，会反复搜索同一患者文件夹和相邻日期文件夹；
+    缓存后只有第一次需要readdir。目录不存在或无权限时返回None，同样缓存，
+    同一缺失路径不会被反复尝试
+    """
+    try:
+        with os.scandir(dir_str) as it:
+            return tuple((entry.name, entry.is_dir()) for entry in it)
+    except OSError:
+        return None
+
 def find_optos_folder(patient_folder, exam_date, search_weeks=1):
     """
     在患者文件夹下查找欧堡图像文件夹
@@ -45,10 +64,13 @@ def find_optos_folder(patient_folder, exam_date, search_weeks=1):
     Returns:
         找到的欧堡文件夹路径，如果未找到返回None
     """
-    patient_path = Path(patient_folder)
+    patient_str = str(patient_folder)
     
-    if not patient_path.exists():
+    # 先列一次患者文件夹，只进入实际存在的日期文件夹，不再逐个日期试探
+    patient_entries = list_dir_entries(patient_str)
+    if patient_entries is None:
         return None
+    date_names = {name for name, is_dir in patient_entries if is_dir}
     
     # 生成需要搜索的日期范围
     dates_to_search = []
@@ -61,21 +83,20 @@ def find_optos_folder(patient_folder, exam_date, search_weeks=1):
         dates_to_search.append(exam_date + timedelta(days=days))
         dates_to_search.append(exam_date - timedelta(days=days))
     
-    # 搜索每个日期
+    # 按日期优先级搜索
     for date in dates_to_search:
         date_str = date.strftime('%Y-%m-%d')
-        date_folder = patient_path / date_str
-        
-        if not date_folder.exists():
+        if date_str not in date_names:
             continue
+        date_folder = os.path.join(patient_str, date_str)
         
-        # 在日期文件夹下查找包含"欧堡"的文件夹
-        try:
-            for item in date_folder.iterdir():
-                if item.is_dir() and '欧堡' in item.name:
-                    return str(item)
-        except Exception as e:
+        # 在日期文件夹下查找欧堡文件夹，找到第一个即返回
+        entries = list_dir_entries(date_folder)
+        if entries is None:
             continue
+        for name, is_dir in entries:
+            if is_dir and OB_FOLDER_RE.search(name):
+                return os.path.join(date_folder, name)
     
     return None
 
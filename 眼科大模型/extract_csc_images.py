@@ -12,9 +12,12 @@ import pandas as pd
 from datetime import datetime
 import fitz  # PyMuPDF
 from PIL import Image
+import numpy as np
 import io
 import re
+import hashlib
 import shutil
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 CPU_COUNT = os.cpu_count() or 1
@@ -26,6 +29,17 @@ except ValueError:
     CSC_WORKERS = DEFAULT_WORKERS
 CSC_WORKERS = max(1, CSC_WORKERS)
 
+# 默认OCT文件夹关键词（按优先级），以及用于一次性筛选候选文件夹的预编译正则
+DEFAULT_OCT_KEYWORDS = ['科林', '视微', '海德堡', 'OCT']
+OCT_FOLDER_RE = re.compile('|'.join(DEFAULT_OCT_KEYWORDS))
+
+# 眼别OCR常见识别错误的修正(0S->OS, 0D->OD, QS->OS, QD->OD),一次正则扫描完成
+OCR_FIX_MAP = {'0S': 'OS', '0D': 'OD', 'QS': 'OS', 'QD': 'OD'}
+OCR_FIX_RE = re.compile('|'.join(OCR_FIX_MAP))
+
+# 就诊日期字段中的日期部分(YYYY-MM-DD)
+VISIT_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
 # 导入FFA提取功能
 sys.path.append('/data2/xuhanyang/眼科大模型')
 from extract_ffa_only import extract_ffa_images_from_pdf
@@ -54,9 +68,9 @@ def parse_visit_date(date_str):
     eye_type = "单眼" if "单眼" in date_str else ("双眼" if "双眼" in date_str else "")
     
     # 提取日期部分
-    date_match = re.search(r'(\d{4}-\d{2}-\d{2})', date_str)
+    date_match = VISIT_DATE_RE.search(date_str)
     if date_match:
-        date_part = date_match.group(1)
+        date_part = date_match.group(0)
         return date_part, eye_type
     
     return None, eye_type
@@ -136,7 +150,7 @@ def find_exam_folder(base_path, patient_folder, visit_date, exam_keyword):
     folders = find_exam_folders(base_path, patient_folder, visit_date, exam_keyword)
     return folders[0] if folders else None
 
-def find_nearest_date_oct_folders(patient_folder, visit_date, oct_keywords=['科林', '视微', '海德堡', 'OCT']):
+def find_nearest_date_oct_folders(patient_folder, visit_date, oct_keywords=None):
     """
     查找最近日期的OCT文件夹(当指定日期找不到时使用)
     
@@ -150,6 +164,12 @@ def find_nearest_date_oct_folders(patient_folder, visit_date, oct_keywords=['科
     """
     from datetime import datetime
     
+    if oct_keywords is None:
+        oct_keywords = DEFAULT_OCT_KEYWORDS
+        oct_folder_re = OCT_FOLDER_RE
+    else:
+        oct_folder_re = re.compile('|'.join(re.escape(kw) for kw in oct_keywords))
+    
     patient_id, patient_name = parse_patient_folder(patient_folder)
     if not patient_id:
         return [], None, None
@@ -191,12 +211,11 @@ def find_nearest_date_oct_folders(patient_folder, visit_date, oct_keywords=['科
                     except:
                         continue
                     
-                    # 查找该日期下的OCT文件夹
+                    # 查找该日期下的OCT文件夹：只列一次子目录，用正则筛出候选，再按关键词优先级归类
+                    candidates = [item for item in date_folder.iterdir()
+                                  if oct_folder_re.search(item.name) and item.is_dir()]
                     for oct_keyword in oct_keywords:
-                        oct_folders = []
-                        for item in date_folder.iterdir():
-                            if item.is_dir() and oct_keyword in item.name:
-                                oct_folders.append(item)
+                        oct_folders = [item for item in candidates if oct_keyword in item.name]
                         
                         if oct_folders:
                             available_dates.append((date_obj, date_str, oct_folders, oct_keyword))
@@ -219,21 +238,314 @@ def find_nearest_date_oct_folders(patient_folder, visit_date, oct_keywords=['科
     
     return nearest[2], nearest[1], nearest[3], days_diff
 
+def find_pdf_files(folder):
+    """
+    递归查找文件夹下的所有PDF文件（后缀不区分大小写）
+    
+    只遍历一次目录树，代替分别rglob('*.pdf')和rglob('*.PDF')的两次遍历
+    """
+    pdf_files = []
+    for root, _dirs, files in os.walk(folder):
+        for name in files:
+            if name.lower().endswith('.pdf'):
+                pdf_files.append(Path(root) / name)
+    return pdf_files
+
 # 全局OCR reader(复用以提高性能)
 _ocr_reader = None
 
+# 眼别OCR参数: 关闭段落合并,使用贪心解码
+EYE_OCR_OPTIONS = {
+    'paragraph': False,
+    'decoder': 'greedy',
+}
+# 右上角小区域只含OD/OS/RIGHT/LEFT角标,额外限制字符集以缩小识别解码的候选空间;
+# 扩大区域和整个顶部区域含其他表头文字,不限制字符集,避免被强行识别成这些字母
+EYE_CORNER_OCR_OPTIONS = dict(EYE_OCR_OPTIONS, allowlist='ODSLEFTRIGH')
+
+# 眼别识别结果缓存: 右上角角标区域缩略图哈希 -> 眼别标识(同一设备/版式的图像角标区域几乎相同),
+# 只缓存识别成功的结果,按最近使用淘汰
+EYE_LABEL_CACHE = OrderedDict()
+EYE_LABEL_CACHE_MAX = 4096
+EYE_LABEL_THUMB_SIZE = (32, 32)
+
+def init_ocr_worker(worker_counter, torch_threads):
+    """
+    OCR工作进程初始化: 分配进程序号(CSC_WORKER_ID)并限制PyTorch线程数,避免多进程争抢CPU
+    
+    Args:
+        worker_counter: multiprocessing.Value计数器,用于给每个进程分配唯一序号
+        torch_threads: 每个进程的PyTorch线程数
+    """
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    os.environ['CSC_WORKER_ID'] = str(worker_id)
+    
+    import torch
+    torch.set_num_threads(torch_threads)
+
 def get_ocr_reader(use_gpu=True):
-    """获取或创建OCR reader(单例模式)"""
+    """
+    获取或创建OCR reader(单例模式,每个进程一个)
+    
+    多进程时只有0号进程(CSC_WORKER_ID为0或未设置)使用GPU,其余进程使用CPU,
+    避免多个进程同时初始化CUDA上下文争抢显存
+    """
     global _ocr_reader
     if _ocr_reader is None:
         import easyocr
         import torch
         # 检查GPU是否可用
-        gpu_available = torch.cuda.is_available() and use_gpu
-        _ocr_reader = easyocr.Reader(['en'], gpu=gpu_available, verbose=False)
+        gpu_available = (
+            use_gpu
+            and os.environ.get('CSC_WORKER_ID', '0') == '0'
+            and torch.cuda.is_available()
+        )
+        _ocr_reader = easyocr.Reader(['en'], gpu=gpu_available, verbose=False,
+                                     cudnn_benchmark=gpu_available)
     return _ocr_reader
 
-def detect_eye_from_oct_image(pil_image, use_gpu=True, try_extended_region=False):
+def pil_to_ocr_array(pil_image):
+    """将PIL图像转换为EasyOCR可直接识别的numpy数组(灰度或RGB),不经过临时文件"""
+    if pil_image.mode not in ('L', 'RGB'):
+        pil_image = pil_image.convert('RGB')
+    return np.asarray(pil_image)
+
+def pad_ocr_arrays(arrays):
+    """用边缘像素把一组数组填充到相同的高宽,便于readtext_batched一次处理"""
+    # 灰度与RGB混合时统一为3通道
+    if any(arr.ndim == 3 for arr in arrays):
+        arrays = [np.repeat(arr[:, :, None], 3, axis=2) if arr.ndim == 2 else arr for arr in arrays]
+    height = max(arr.shape[0] for arr in arrays)
+    width = max(arr.shape[1] for arr in arrays)
+    padded = []
+    for arr in arrays:
+        pad = [(0, height - arr.shape[0]), (0, width - arr.shape[1])] + [(0, 0)] * (arr.ndim - 2)
+        padded.append(np.pad(arr, pad, mode='edge'))
+    return padded, height, width
+
+def parse_eye_from_ocr_results(results):
+    """
+    从EasyOCR结果(detail=1)中解析眼别
+    
+    Returns:
+        眼别标识字符串 "_OD", "_OS" 或 ""
+    """
+    # 合并所有识别的文本
+    text = ' '.join([result[1].upper() for result in results])
+    
+    # 检测OD/OS (处理OCR可能的错误)
+    # 常见OCR错误: 0S->OS, 0D->OD, QS->OS, QD->OD
+    text = OCR_FIX_RE.sub(lambda m: OCR_FIX_MAP[m.group()], text)
+    
+    has_od = 'OD' in text or 'RIGHT' in text
+    has_os = 'OS' in text or 'LEFT' in text
+    
+    if has_od and not has_os:
+        return "_OD"
+    elif has_os and not has_od:
+        return "_OS"
+    elif has_od and has_os:
+        # 如果同时检测到OD和OS,选择先出现的
+        od_pos = text.find('OD') if 'OD' in text else (text.find('RIGHT') if 'RIGHT' in text else float('inf'))
+        os_pos = text.find('OS') if 'OS' in text else (text.find('LEFT') if 'LEFT' in text else float('inf'))
+        return "_OD" if od_pos < os_pos else "_OS"
+    
+    return ""
+
+def enhance_contrast(region, factor=2.0):
+    """
+    增强对比度(与ImageEnhance.Contrast相同:以灰度均值为中心按factor拉伸)
+    
+    用一次point查找表完成,代替ImageEnhance先生成同尺寸均值图再blend的两遍像素运算;
+    部署环境安装Pillow-SIMD时point/crop会自动使用SIMD实现
+    """
+    if region.mode not in ('L', 'RGB'):
+        from PIL import ImageEnhance
+        return ImageEnhance.Contrast(region).enhance(factor)
+    
+    from PIL import ImageStat
+    mean = int(ImageStat.Stat(region.convert('L')).mean[0] + 0.5)
+    lut = [min(255, max(0, int(mean + factor * (v - mean)))) for v in range(256)]
+    return region.point(lut * len(region.getbands()))
+
+def crop_eye_detection_regions(pil_image, try_extended_region=False):
+    """
+    裁剪OCT图像中用于识别眼别的区域(按优先级排序)并增强对比度
+    
+    Returns:
+        各区域的numpy数组列表
+    """
+    width, height = pil_image.size
+    
+    # 定义多个检测区域(按优先级排序)
+    detection_regions = [
+        # 1. 最右上角小区域 (专门针对像您图片中那种右上角标记)
+        (int(width * 0.92), 0, width, int(height * 0.08), "right_corner"),
+        # 2. 标准右上角区域
+        (int(width * 0.80), 0, width, int(height * 0.12), "standard"),
+    ]
+    
+    # 如果允许扩展搜索,添加更大的区域
+    if try_extended_region:
+        detection_regions.extend([
+            # 3. 扩大右上角区域
+            (int(width * 0.70), 0, width, int(height * 0.20), "extended"),
+            # 4. 整个顶部区域
+            (0, 0, width, int(height * 0.15), "full_top"),
+        ])
+    
+    # 裁剪各检测区域并增强对比度
+    region_arrays = []
+    for x1, y1, x2, y2, region_name in detection_regions:
+        try:
+            # 角标文字为黑白,转灰度后对比度增强和送入OCR的数据量都只有RGB的1/3
+            region = pil_image.crop((x1, y1, x2, y2)).convert('L')
+            
+            # 增强对比度以提高OCR准确率
+            region = enhance_contrast(region, 2.0)  # 增强对比度2倍
+            
+            region_arrays.append(pil_to_ocr_array(region))
+        except Exception as e:
+            continue  # 如果某个区域失败,尝试下一个
+    
+    return region_arrays
+
+def detect_eye_from_oct_images_batched(pil_images, reader, batch_size=32):
+    """
+    一次批量OCR多张OCT图像的标准检测区域(GPU下使用)
+    
+    结果与逐张调用detect_eye_from_oct_image(try_extended_region=False)一致
+    
+    Returns:
+        与pil_images一一对应的眼别标识列表
+    """
+    region_arrays = []
+    owners = []  # 每个区域所属图像的下标
+    for image_idx, pil_image in enumerate(pil_images):
+        try:
+            arrays = crop_eye_detection_regions(pil_image)
+        except Exception as e:
+            continue
+        region_arrays.extend(arrays)
+        owners.extend([image_idx] * len(arrays))
+    
+    labels = [""] * len(pil_images)
+    if not region_arrays:
+        return labels
+    
+    batch, height, width = pad_ocr_arrays(region_arrays)
+    batch_results = reader.readtext_batched(batch, n_width=width, n_height=height,
+                                            batch_size=min(batch_size, len(batch)),
+                                            **EYE_CORNER_OCR_OPTIONS)
+    
+    # 区域按图像内优先级排列,每张图像取第一个识别成功的区域
+    for image_idx, results in zip(owners, batch_results):
+        if not labels[image_idx]:
+            labels[image_idx] = parse_eye_from_ocr_results(results)
+    return labels
+
+# 眼别OCR用图像的最大边长(只识别角标区域,超大图像先缩小)
+OCR_IMAGE_MAX_SIZE = 2048
+
+# 同一PDF中逐张OCR连续失败达到该数量后,剩余图像不再逐张OCR(只用页面级兜底)
+OCR_MAX_FAILED_IMAGES = 3
+
+def may_be_oct_image(img):
+    """
+    按get_images返回的图像信息(xref, smask, width, height, ...)判断是否可能是OCT图像
+    
+    OCT图像通常至少有300x300像素,更小的是标题图和logo,无需取出图像数据;
+    个别PDF此处宽高为0,无法据此判断,保留为候选,取出图像后再按实际尺寸过滤
+    """
+    return not (0 < img[2] < 300 or 0 < img[3] < 300)
+
+def open_image_for_ocr(image_bytes):
+    """
+    解码PDF内嵌图像用于眼别OCR
+    
+    JPEG通过draft在解码时直接按1/2、1/4等比例缩小,其他格式解码后再缩略,
+    最大边长不超过OCR_IMAGE_MAX_SIZE
+    """
+    pil_image = Image.open(io.BytesIO(image_bytes))
+    pil_image.draft('RGB', (OCR_IMAGE_MAX_SIZE, OCR_IMAGE_MAX_SIZE))
+    pil_image.thumbnail((OCR_IMAGE_MAX_SIZE, OCR_IMAGE_MAX_SIZE), Image.BILINEAR)
+    return pil_image
+
+def prefetch_pdf_eye_labels(doc, reader):
+    """
+    先解码PDF中所有候选OCT图像(过滤小图),一次批量OCR其标准检测区域
+    
+    Returns:
+        (decoded_images, labels): 均以(page_num, img_index)为键;
+        labels为批量识别结果,批量失败时为空字典
+    """
+    keys = []
+    pil_images = []
+    seen_xrefs = set()
+    for page_num in range(len(doc)):
+        for img_index, img in enumerate(doc[page_num].get_images()):
+            # 与提取时相同的过滤条件: OCT图像通常至少有300x300像素
+            # 重复引用的同一xref只解码一次
+            if not may_be_oct_image(img) or img[0] in seen_xrefs:
+                continue
+            seen_xrefs.add(img[0])
+            try:
+                base_image = doc.extract_image(img[0])
+                if base_image["width"] < 300 or base_image["height"] < 300:
+                    continue
+                pil_image = open_image_for_ocr(base_image["image"])
+            except Exception as e:
+                continue
+            keys.append((page_num, img_index))
+            pil_images.append(pil_image)
+    
+    decoded_images = dict(zip(keys, pil_images))
+    try:
+        labels = dict(zip(keys, detect_eye_from_oct_images_batched(pil_images, reader)))
+    except Exception as e:
+        labels = {}
+    return decoded_images, labels
+
+def detect_eye_from_region_arrays(region_arrays, reader, ocr_options=EYE_OCR_OPTIONS):
+    """
+    按优先级对各检测区域进行OCR,返回第一个识别出的眼别
+    
+    Args:
+        region_arrays: 各检测区域的numpy数组列表
+        reader: OCR reader
+        ocr_options: 传给readtext的OCR参数
+    
+    Returns:
+        眼别标识字符串 "_OD", "_OS" 或 ""
+    """
+    if getattr(reader, 'device', 'cpu') != 'cpu' and len(region_arrays) > 1:
+        # GPU: 所有区域填充到相同尺寸后一次批量OCR,按优先级取第一个识别成功的区域
+        try:
+            batch, height, width = pad_ocr_arrays(region_arrays)
+            batch_results = reader.readtext_batched(batch, n_width=width, n_height=height,
+                                                    batch_size=len(batch), **ocr_options)
+            for results in batch_results:
+                eye_label = parse_eye_from_ocr_results(results)
+                if eye_label:
+                    return eye_label
+            return ""
+        except Exception as e:
+            pass  # 批量失败时退回逐个区域识别
+    
+    # CPU: 逐个区域识别,第一个区域命中即返回,避免多余的检测计算
+    for region_array in region_arrays:
+        try:
+            eye_label = parse_eye_from_ocr_results(reader.readtext(region_array, **ocr_options))
+            if eye_label:
+                return eye_label
+        except Exception as e:
+            continue  # 如果某个区域失败,尝试下一个
+    
+    return ""
+
+def detect_eye_from_oct_image(pil_image, use_gpu=True, try_extended_region=False, reader=None):
     """
     使用OCR从OCT图像右上角识别眼别
     
@@ -241,143 +553,75 @@ def detect_eye_from_oct_image(pil_image, use_gpu=True, try_extended_region=False
         pil_image: PIL图像对象
         use_gpu: 是否使用GPU加速
         try_extended_region: 是否尝试扩大搜索区域(仅在首次失败时使用)
+        reader: 调用方预先创建的OCR reader(不提供时使用全局单例)
     
     Returns:
         眼别标识字符串 "_OD", "_OS" 或 ""
     """
     try:
-        import tempfile
-        from PIL import ImageEnhance
+        if reader is None:
+            reader = get_ocr_reader(use_gpu=use_gpu)
         
+        # 以最右上角小区域的32x32灰度缩略图为键,命中时直接复用识别结果,跳过裁剪和OCR
         width, height = pil_image.size
-        reader = get_ocr_reader(use_gpu=use_gpu)
-        
-        # 定义多个检测区域(按优先级排序)
-        detection_regions = [
-            # 1. 最右上角小区域 (专门针对像您图片中那种右上角标记)
-            (int(width * 0.92), 0, width, int(height * 0.08), "right_corner"),
-            # 2. 标准右上角区域
-            (int(width * 0.80), 0, width, int(height * 0.12), "standard"),
-        ]
-        
-        # 如果允许扩展搜索,添加更大的区域
-        if try_extended_region:
-            detection_regions.extend([
-                # 3. 扩大右上角区域
-                (int(width * 0.70), 0, width, int(height * 0.20), "extended"),
-                # 4. 整个顶部区域
-                (0, 0, width, int(height * 0.15), "full_top"),
-            ])
-        
-        # 尝试每个检测区域
-        for x1, y1, x2, y2, region_name in detection_regions:
-            try:
-                # 裁剪区域
-                region = pil_image.crop((x1, y1, x2, y2))
-                
-                # 增强对比度以提高OCR准确率
-                enhancer = ImageEnhance.Contrast(region)
-                region = enhancer.enhance(2.0)  # 增强对比度2倍
-                
-                # 保存临时文件用于OCR
-                with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                    region.save(tmp.name)
-                    tmp_path = tmp.name
-                
-                # OCR识别
-                results = reader.readtext(tmp_path)
-                Path(tmp_path).unlink()
-                
-                # 合并所有识别的文本
-                text = ' '.join([result[1].upper() for result in results])
-                
-                # 检测OD/OS (处理OCR可能的错误)
-                # 常见OCR错误: 0S->OS, 0D->OD, QS->OS, QD->OD
-                text = text.replace('0S', 'OS').replace('0D', 'OD')
-                text = text.replace('QS', 'OS').replace('QD', 'OD')
-                
-                has_od = 'OD' in text or 'RIGHT' in text
-                has_os = 'OS' in text or 'LEFT' in text
-                
-                if has_od and not has_os:
-                    return "_OD"
-                elif has_os and not has_od:
-                    return "_OS"
-                elif has_od and has_os:
-                    # 如果同时检测到OD和OS,选择先出现的
-                    od_pos = text.find('OD') if 'OD' in text else (text.find('RIGHT') if 'RIGHT' in text else float('inf'))
-                    os_pos = text.find('OS') if 'OS' in text else (text.find('LEFT') if 'LEFT' in text else float('inf'))
-                    return "_OD" if od_pos < os_pos else "_OS"
-                
-            except Exception as e:
-                continue  # 如果某个区域失败,尝试下一个
+        corner = pil_image.crop((int(width * 0.92), 0, width, int(height * 0.08)))
+        thumb = corner.convert('L').resize(EYE_LABEL_THUMB_SIZE, Image.BILINEAR)
+        cache_key = hashlib.blake2b(thumb.tobytes(), digest_size=16).digest()
+        if cache_key in EYE_LABEL_CACHE:
+            EYE_LABEL_CACHE.move_to_end(cache_key)
+            return EYE_LABEL_CACHE[cache_key]
+        
+        region_arrays = crop_eye_detection_regions(pil_image, try_extended_region)
+        
+        # 只有右上角小区域时限制字符集,包含扩大区域时不限制
+        ocr_options = EYE_OCR_OPTIONS if try_extended_region else EYE_CORNER_OCR_OPTIONS
+        eye_label = detect_eye_from_region_arrays(region_arrays, reader, ocr_options)
+        if eye_label:
+            EYE_LABEL_CACHE[cache_key] = eye_label
+            if len(EYE_LABEL_CACHE) > EYE_LABEL_CACHE_MAX:
+                EYE_LABEL_CACHE.popitem(last=False)
+        return eye_label
         
     except Exception as e:
         pass
     
     return ""
 
-def detect_eye_from_pdf_page(page, use_gpu=False):
+def detect_eye_from_pdf_page(page, use_gpu=False, reader=None):
     """
     通过渲染PDF页面并OCR识别右上角的眼别标记
     
     Args:
         page: PyMuPDF页面对象
         use_gpu: 是否使用GPU进行OCR
+        reader: 调用方预先创建的OCR reader(不提供时使用全局单例)
     
     Returns:
         眼别标识字符串 "_OD", "_OS" 或 ""
     """
     try:
-        import tempfile
-        
-        # 渲染页面为图像 (2倍分辨率以提高OCR准确率)
+        # 只以灰度渲染右上角区域 (90%-100%宽度, 0-8%高度),2倍分辨率以提高OCR准确率
+        rect = page.rect
+        clip = fitz.Rect(rect.x0 + rect.width * 0.90, rect.y0, rect.x1, rect.y0 + rect.height * 0.08)
         mat = fitz.Matrix(2.0, 2.0)
-        pix = page.get_pixmap(matrix=mat)
-        
-        # 转换为PIL图像
-        page_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        width, height = page_img.size
-        
-        # 裁剪右上角区域 (90%-100%宽度, 0-8%高度)
-        right_top = page_img.crop((int(width * 0.90), 0, width, int(height * 0.08)))
-        
-        # 保存临时文件用于OCR
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            right_top.save(tmp.name)
-            tmp_path = tmp.name
-        
-        # OCR识别
-        reader = get_ocr_reader(use_gpu=use_gpu)
-        results = reader.readtext(tmp_path)
-        Path(tmp_path).unlink()
-        
-        # 合并所有识别的文本
-        text = ' '.join([result[1].upper() for result in results])
+        pix = page.get_pixmap(matrix=mat, clip=clip, colorspace=fitz.csGRAY, alpha=False)
         
-        # 检测OD/OS (处理OCR可能的错误)
-        text = text.replace('0S', 'OS').replace('0D', 'OD')
-        text = text.replace('QS', 'OS').replace('QD', 'OD')
+        # 直接在pixmap缓冲区上建立numpy视图(单通道)
+        samples = getattr(pix, 'samples_mv', None) or pix.samples
+        right_top = np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.width)
         
-        has_od = 'OD' in text or 'RIGHT' in text
-        has_os = 'OS' in text or 'LEFT' in text
-        
-        if has_od and not has_os:
-            return "_OD"
-        elif has_os and not has_od:
-            return "_OS"
-        elif has_od and has_os:
-            od_pos = text.find('OD') if 'OD' in text else (text.find('RIGHT') if 'RIGHT' in text else float('inf'))
-            os_pos = text.find('OS') if 'OS' in text else (text.find('LEFT') if 'LEFT' in text else float('inf'))
-            return "_OD" if od_pos < os_pos else "_OS"
+        # OCR识别(直接传入内存中的数组)
+        if reader is None:
+            reader = get_ocr_reader(use_gpu=use_gpu)
+        results = reader.readtext(right_top, **EYE_CORNER_OCR_OPTIONS)
+        return parse_eye_from_ocr_results(results)
         
     except Exception as e:
         pass
     
     return ""
 
-def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_prefix="", use_gpu_ocr=False, cached_eye_label=None, pdf_index=1):
+def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_prefix="", use_gpu_ocr=False, cached_eye_label=None, pdf_index=1, reader=None, return_eye_label=False):
     """
     从OCT PDF中提取图像,识别眼别和标签
     
@@ -388,9 +632,11 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
         folder_prefix: 文件夹前缀(用于区分不同OCT类型,如"血流模式")
         use_gpu_ocr: 是否使用GPU进行OCR(多进程环境下建议False)
         cached_eye_label: 预先识别的眼别标识(如果提供,跳过OCR步骤以加速)
+        reader: 调用方预先创建的OCR reader(多个PDF共用,不提供时使用全局单例)
+        return_eye_label: 是否同时返回该PDF识别出的眼别(供调用方缓存)
     
     Returns:
-        提取的图像数量
+        提取的图像数量; return_eye_label为True时返回(提取的图像数量, 眼别标识或None)
     """
     pdf_path = Path(pdf_path)
     output_dir = Path(output_dir)
@@ -406,56 +652,89 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
         # 优化: 不再一上来就渲染PDF,而是先尝试从提取的图像识别
         # 只有当提取的图像都无法识别时,才渲染PDF第一页(作为最后手段)
         tried_pdf_page_render = False
+        ocr_fail_count = 0
+        # 同一图像(同一xref)可能在多页重复引用,只提取一次
+        seen_xrefs = set()
+        
+        # 先对第一个含OCT图像的页面做页面级角标识别(通常即可确定整个PDF的眼别);
+        # 仍未识别时,GPU下再把所有图像的标准区域一次批量OCR(结果与逐张第一次尝试相同),
+        # CPU下逐张识别、命中即缓存更省计算,保持原流程
+        decoded_images = {}
+        batched_labels = {}
+        checked_page_num = None
+        if not pdf_eye_label:
+            if reader is None:
+                reader = get_ocr_reader(use_gpu=use_gpu_ocr)
+            for page_num in range(len(doc)):
+                page = doc[page_num]
+                if any(may_be_oct_image(img) for img in page.get_images()):
+                    pdf_eye_label = detect_eye_from_pdf_page(page, use_gpu=use_gpu_ocr, reader=reader) or None
+                    checked_page_num = page_num
+                    if page_num == 0:
+                        tried_pdf_page_render = True
+                    break
+            if not pdf_eye_label and getattr(reader, 'device', 'cpu') != 'cpu':
+                decoded_images, batched_labels = prefetch_pdf_eye_labels(doc, reader)
         
         for page_num in range(len(doc)):
             page = doc[page_num]
             image_list = page.get_images()
             
-            # 提取页面文本和图像位置信息
-            text_dict = page.get_text("dict")
-            
-            # 提取所有文本块及其位置（用于匹配图像标签）
-            text_blocks = []
-            for block in text_dict["blocks"]:
-                if "lines" in block:
-                    for line in block["lines"]:
-                        for span in line["spans"]:
-                            text_content = span["text"].strip()
-                            if text_content:
-                                bbox = span["bbox"]
-                                text_blocks.append({
-                                    'text': text_content,
-                                    'x': bbox[0],
-                                    'y': bbox[1]
-                                })
+            # 先识别页面右上角的眼别角标: 只渲染角标区域,代价与单次图像OCR相当,
+            # 识别成功则本页(及后续)所有图像直接使用,无需逐张OCR
+            # (第一个含OCT图像的页面已在上面识别过)
+            if (not pdf_eye_label and page_num != checked_page_num
+                    and any(may_be_oct_image(img) for img in image_list)):
+                page_eye_label = detect_eye_from_pdf_page(page, use_gpu=use_gpu_ocr, reader=reader)
+                if page_eye_label:
+                    pdf_eye_label = page_eye_label
+                if page_num == 0:
+                    tried_pdf_page_render = True
             
             for img_index, img in enumerate(image_list):
                 xref = img[0]
+                # 先按get_images返回的尺寸过滤小图（标题图和logo）,无需取出或解码图像数据;
+                # 尺寸为0时在extract_image之后再按实际尺寸判断
+                if not may_be_oct_image(img):
+                    continue
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+                
                 base_image = doc.extract_image(xref)
+                # OCT图像通常至少有300x300像素
+                if base_image["width"] < 300 or base_image["height"] < 300:
+                    continue
                 image_bytes = base_image["image"]
                 image_ext = base_image["ext"]
                 
                 try:
-                    pil_image = Image.open(io.BytesIO(image_bytes))
-                    width, height = pil_image.size
-                    
-                    # 过滤小图（标题图和logo）
-                    # OCT图像通常至少有300x300像素
-                    if width < 300 or height < 300:
-                        continue
-                    
                     total_images += 1
                     
                     # 优先使用PDF级别缓存的眼别(同一PDF的图片通常是同一只眼睛)
                     if pdf_eye_label:
                         eye_label = pdf_eye_label
                     else:
-                        # 第一次尝试: 对提取的图像进行标准OCR识别(快!)
-                        eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=False)
-                        
-                        if not eye_label:
-                            # 第二次尝试: 使用扩大区域的OCR
-                            eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=True)
+                        eye_label = ""
+                        # 前几张图像都识别失败时,后续图像大概率同样失败,不再逐张OCR
+                        if ocr_fail_count < OCR_MAX_FAILED_IMAGES:
+                            # 只有需要OCR时才解码图像
+                            pil_image = decoded_images.pop((page_num, img_index), None)
+                            if pil_image is None:
+                                pil_image = open_image_for_ocr(image_bytes)
+                            
+                            # 第一次尝试: 对提取的图像进行标准OCR识别(快!)
+                            if (page_num, img_index) in batched_labels:
+                                eye_label = batched_labels[(page_num, img_index)]
+                            else:
+                                eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=False, reader=reader)
+                            
+                            if not eye_label:
+                                # 第二次尝试: 使用扩大区域的OCR
+                                eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=True, reader=reader)
+                            
+                            if not eye_label:
+                                ocr_fail_count += 1
                         
                         if not eye_label:
                             # 第三次尝试: 从PDF文本识别
@@ -471,7 +750,7 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
                         if not eye_label and not tried_pdf_page_render and page_num == 0:
                             # 第四次尝试(最后手段): 渲染PDF第一页进行OCR识别(慢!)
                             # 只在所有图像OCR都失败且是第一页时才尝试
-                            eye_label = detect_eye_from_pdf_page(doc[0], use_gpu=use_gpu_ocr)
+                            eye_label = detect_eye_from_pdf_page(doc[0], use_gpu=use_gpu_ocr, reader=reader)
                             tried_pdf_page_render = True
                         
                         # 成功识别到眼别后,缓存结果供后续图片使用
@@ -480,27 +759,6 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
                         # 如果当前图片仍未识别出眼别,继续尝试下一张图片
                         # (不缓存,继续OCR后续图片)
                     
-                    # 获取图像位置
-                    img_rects = page.get_image_rects(xref)
-                    
-                    # 查找最近的文本标签
-                    label = ""
-                    if img_rects and text_blocks:
-                        img_rect = img_rects[0]
-                        img_x = img_rect.x0
-                        img_y = img_rect.y0
-                        min_distance = float('inf')
-                        
-                        for tb in text_blocks:
-                            y_distance = abs(tb['y'] - img_y)
-                            x_distance = abs(tb['x'] - img_x)
-                            
-                            # 优先查找图像上方和左侧的标签
-                            if y_distance < 80:  # 扩大Y轴搜索范围
-                                if x_distance < min_distance:
-                                    min_distance = x_distance
-                                    label = tb['text']
-                    
                     # 生成简短文件名: 眼别_文件夹前缀_位置
                     # OCT图像命名为: 眼别_文件夹前缀_位置 (如 OD_血流模式_main, OS_main)
                     eye_str = eye_label.strip('_') if eye_label else 'unknown'
@@ -515,17 +773,22 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
                         # 单图命名为 眼别_前缀_PDF编号_main
                         output_name = f"{eye_str}_{prefix_str}{pdf_str}main.{image_ext}"
                     
+                    # 直接写出PDF内嵌的原始图像数据(扩展名即其格式),避免解码后再重新编码
                     output_path = output_dir / output_name
-                    pil_image.save(output_path)
+                    output_path.write_bytes(image_bytes)
                     
                 except Exception as e:
                     print(f"    警告: 图像 {img_index + 1} 保存失败 - {e}")
         
         doc.close()
+        if return_eye_label:
+            return total_images, pdf_eye_label
         return total_images
         
     except Exception as e:
         print(f"    错误: 无法处理PDF - {e}")
+        if return_eye_label:
+            return 0, None
         return 0
 
 def process_single_case(row, oct_type, output_base_dir, year):
@@ -692,8 +955,8 @@ def process_single_case(row, oct_type, output_base_dir, year):
                 folder_idx = oct_folders.index(oct_folder) + 1
                 folder_prefix = f"folder{folder_idx}"
             
-            # 同时搜索小写.pdf和大写.PDF
-            oct_pdfs = sorted(list(oct_folder.rglob('*.pdf')) + list(oct_folder.rglob('*.PDF')))
+            # 同时搜索小写.pdf和大写.PDF（一次遍历）
+            oct_pdfs = sorted(find_pdf_files(oct_folder))
             if oct_pdfs:
                 for pdf_idx, pdf in enumerate(oct_pdfs, 1):
                     # 多进程环境下禁用GPU OCR,避免资源竞争
@@ -714,8 +977,8 @@ def process_single_case(row, oct_type, output_base_dir, year):
         result['ffa_path'] = str(ffa_folder)
         
         # 提取FFA图像（使用已有的FFA提取工具）
-        # 同时搜索小写.pdf和大写.PDF
-        ffa_pdfs = list(ffa_folder.rglob('*.pdf')) + list(ffa_folder.rglob('*.PDF'))
+        # 同时搜索小写.pdf和大写.PDF（一次遍历）
+        ffa_pdfs = find_pdf_files(ffa_folder)
         if ffa_pdfs:
             for idx, pdf in enumerate(ffa_pdfs, 1):  # 传入pdf编号
                 extract_result = extract_ffa_images_from_pdf(pdf, ffa_output_dir, pdf_index=idx)
@@ -795,7 +1058,8 @@ def process_excel_file(excel_path, oct_type, output_base_dir):
                 print(f"    - {error}")
         print()
 
-    rows_payload = [(idx, df.iloc[idx].to_dict()) for idx in range(total_cases)]
+    # 一次性转换为字典列表，避免逐行iloc构造Series再转dict
+    rows_payload = list(enumerate(df.to_dict(orient='records')))
 
     if worker_count == 1:
         for idx, row_dict in rows_payload:
@@ -887,40 +1151,44 @@ def main():
     report_path = output_base_dir / "提取报告.txt"
     output_base_dir.mkdir(parents=True, exist_ok=True)
     
+    # 报告内容先在内存中拼接, 最后一次写出
+    parts = []
+    parts.append("="*70 + "\n")
+    parts.append("糖尿病性视网膜病变 - 图像提取报告\n")
+    parts.append("="*70 + "\n\n")
+    parts.append(f"处理时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    parts.append(f"输出目录: {output_base_dir}\n\n")
+    
+    parts.append(f"总病例数: {total_cases}\n")
+    parts.append(f"找到OCT: {oct_found} ({oct_found/total_cases*100:.1f}%)\n")
+    parts.append(f"找到FFA: {ffa_found} ({ffa_found/total_cases*100:.1f}%)\n")
+    parts.append(f"提取OCT图像: {total_oct_images} 张\n")
+    parts.append(f"提取FFA图像: {total_ffa_images} 张\n")
+    parts.append(f"有问题的病例: {cases_with_errors}\n\n")
+    
+    parts.append("="*70 + "\n")
+    parts.append("详细病例列表\n")
+    parts.append("="*70 + "\n\n")
+    
+    for i, r in enumerate(all_results, 1):
+        parts.append(f"{i}. {r['patient_name']} - {r['visit_date']} ({r['eye_type']})\n")
+        parts.append(f"   OCT: {'✓' if r['oct_found'] else '✗'} ({r['oct_extracted']}张)\n")
+        parts.append(f"   FFA: {'✓' if r['ffa_found'] else '✗'} ({r['ffa_extracted']}张)\n")
+        
+        if r['errors']:
+            parts.append(f"   问题:\n")
+            for error in r['errors']:
+                parts.append(f"     - {error}\n")
+        
+        if r['oct_path']:
+            parts.append(f"   OCT路径: {r['oct_path']}\n")
+        if r['ffa_path']:
+            parts.append(f"   FFA路径: {r['ffa_path']}\n")
+        
+        parts.append("\n")
+
     with open(report_path, 'w', encoding='utf-8') as f:
-        f.write("="*70 + "\n")
-        f.write("糖尿病性视网膜病变 - 图像提取报告\n")
-        f.write("="*70 + "\n\n")
-        f.write(f"处理时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"输出目录: {output_base_dir}\n\n")
-        
-        f.write(f"总病例数: {total_cases}\n")
-        f.write(f"找到OCT: {oct_found} ({oct_found/total_cases*100:.1f}%)\n")
-        f.write(f"找到FFA: {ffa_found} ({ffa_found/total_cases*100:.1f}%)\n")
-        f.write(f"提取OCT图像: {total_oct_images} 张\n")
-        f.write(f"提取FFA图像: {total_ffa_images} 张\n")
-        f.write(f"有问题的病例: {cases_with_errors}\n\n")
-        
-        f.write("="*70 + "\n")
-        f.write("详细病例列表\n")
-        f.write("="*70 + "\n\n")
-        
-        for i, r in enumerate(all_results, 1):
-            f.write(f"{i}. {r['patient_name']} - {r['visit_date']} ({r['eye_type']})\n")
-            f.write(f"   OCT: {'✓' if r['oct_found'] else '✗'} ({r['oct_extracted']}张)\n")
-            f.write(f"   FFA: {'✓' if r['ffa_found'] else '✗'} ({r['ffa_extracted']}张)\n")
-            
-            if r['errors']:
-                f.write(f"   问题:\n")
-                for error in r['errors']:
-                    f.write(f"     - {error}\n")
-            
-            if r['oct_path']:
-                f.write(f"   OCT路径: {r['oct_path']}\n")
-            if r['ffa_path']:
-                f.write(f"   FFA路径: {r['ffa_path']}\n")
-            
-            f.write("\n")
+        f.write("".join(parts))
     
     print(f"\n详细报告已保存: {report_path}")
     print("="*70)
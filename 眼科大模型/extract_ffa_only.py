@@ -14,7 +14,7 @@ import fitz  # PyMuPDF
 from PIL import Image
 import numpy as np
 
-def analyze_pdf_info(pdf_path, brightness_threshold=80):
+def analyze_pdf_info(pdf_path, brightness_threshold=80, doc=None):
     """
     分析PDF的类型（FFA/ICGA/IR）和眼别（OD/OS）
     
@@ -23,13 +23,16 @@ def analyze_pdf_info(pdf_path, brightness_threshold=80):
     Args:
         pdf_path: PDF文件路径
         brightness_threshold: 亮度阈值（备用方法）
+        doc: 调用方已打开的fitz文档（提供时直接复用且不关闭，避免同一PDF打开两次）
     
     Returns:
         dict: {'type': str, 'eye': str, 'has_ir': bool, 'has_ffa': bool} 或 None
         type: 'FFA', 'ICGA', 'IR', 'FFA+IR', 'MIXED'
     """
+    own_doc = doc is None
     try:
-        doc = fitz.open(pdf_path)
+        if own_doc:
+            doc = fitz.open(pdf_path)
         page = doc[0]
         
         # 方法1：从PDF文本内容判断（最准确）
@@ -55,45 +58,40 @@ def analyze_pdf_info(pdf_path, brightness_threshold=80):
         chinese_right_keywords = ['右眼']
         chinese_left_keywords = ['左眼']
         
-        right_positions = []
-        left_positions = []
-        
+        # 只需要各关键词第一次出现的位置（最小值），不必记录所有出现位置
+        od_min = sys.maxsize
+        os_min = sys.maxsize
+
         for kw in right_keywords_upper:
             pos = text_upper.find(kw)
-            while pos != -1:
-                right_positions.append(pos)
-                pos = text_upper.find(kw, pos + len(kw))
-        
+            if pos != -1 and pos < od_min:
+                od_min = pos
+
         for kw in left_keywords_upper:
             pos = text_upper.find(kw)
-            while pos != -1:
-                left_positions.append(pos)
-                pos = text_upper.find(kw, pos + len(kw))
-        
+            if pos != -1 and pos < os_min:
+                os_min = pos
+
         for kw in chinese_right_keywords:
             pos = text.find(kw)
-            while pos != -1:
-                right_positions.append(pos)
-                pos = text.find(kw, pos + len(kw))
-        
+            if pos != -1 and pos < od_min:
+                od_min = pos
+
         for kw in chinese_left_keywords:
             pos = text.find(kw)
-            while pos != -1:
-                left_positions.append(pos)
-                pos = text.find(kw, pos + len(kw))
-        
-        has_od = bool(right_positions)
-        has_os = bool(left_positions)
-        
+            if pos != -1 and pos < os_min:
+                os_min = pos
+
+        has_od = od_min != sys.maxsize
+        has_os = os_min != sys.maxsize
+
         if has_od and not has_os:
             eye = "右眼(OD)"
         elif has_os and not has_od:
             eye = "左眼(OS)"
         elif has_od and has_os:
             # 两者都有，看哪个先出现
-            od_pos = min(right_positions)
-            os_pos = min(left_positions)
-            eye = "右眼(OD)" if od_pos < os_pos else "左眼(OS)"
+            eye = "右眼(OD)" if od_min < os_min else "左眼(OS)"
         else:
             eye = "未知"
         
@@ -105,7 +103,8 @@ def analyze_pdf_info(pdf_path, brightness_threshold=80):
         has_ir = ir_count > 0
         
         if has_ffa or has_icga or has_ir:
-            doc.close()
+            if own_doc:
+                doc.close()
             
             # 确定主要类型
             if has_icga and icga_count > fa_count:
@@ -135,7 +134,8 @@ def analyze_pdf_info(pdf_path, brightness_threshold=80):
         image_list = page.get_images()
         
         if len(image_list) < 3:
-            doc.close()
+            if own_doc:
+                doc.close()
             return None  # 无法判断
         
         # 提取第3张图像（通常是第一张医学图像，前两张是标题）
@@ -148,7 +148,8 @@ def analyze_pdf_info(pdf_path, brightness_threshold=80):
         arr = np.array(pil_image)
         mean_brightness = arr.mean()
         
-        doc.close()
+        if own_doc:
+            doc.close()
         
         # FFA图像通常较暗（使用备用方法时无法判断眼别）
         is_ffa = mean_brightness < brightness_threshold
@@ -177,7 +178,17 @@ def is_fa_icga_combined_image(pil_image, pdf_info=None):
         bool: 如果是组合图像返回True
     """
     width, height = pil_image.size
-    
+
+    # 判断标准3: 宽度足够大（通常组合图像宽度>1000），不满足时无需继续判断
+    if width < 1000:
+        return False
+
+    # PDF文本已明确判断出不同时含FA和ICGA时（单模态PDF，占大多数），不可能是组合图像
+    # 亮度备用方法得到的pdf_info没有icga_count，不能据此排除
+    if pdf_info and 'icga_count' in pdf_info:
+        if not (pdf_info.get('has_ffa') and pdf_info.get('has_icga')):
+            return False
+
     # 判断标准1: 宽度大约是高度的2倍（比例在1.8-2.2之间）
     aspect_ratio = width / height if height > 0 else 0
     is_combined_by_size = 1.8 <= aspect_ratio <= 2.2
@@ -195,11 +206,8 @@ def is_fa_icga_combined_image(pil_image, pdf_info=None):
             # 允许±1的容差，因为可能有计数误差
             count_diff = abs(fa_count - icga_count)
             is_combined_by_pdf_info = count_diff <= 1
-    
-    # 判断标准3: 宽度足够大（通常组合图像宽度>1000）
-    is_large_enough = width >= 1000
-    
-    return (is_combined_by_size or is_combined_by_pdf_info) and is_large_enough
+
+    return is_combined_by_size or is_combined_by_pdf_info
 
 def crop_fa_from_combined_image(pil_image):
     """
@@ -216,6 +224,25 @@ def crop_fa_from_combined_image(pil_image):
     left_half = pil_image.crop((0, 0, width // 2, height))
     return left_half
 
+def save_image_no_optimize(pil_image, output_path, image_ext):
+    """
+    按已知格式保存图像,不做格式探测和额外的压缩优化(只需落盘像素)
+    
+    Args:
+        pil_image: PIL图像对象
+        output_path: 输出路径
+        image_ext: 图像格式扩展名(如 png/jpeg)
+    """
+    image_ext = image_ext.lower()
+    if image_ext in ('jpg', 'jpeg'):
+        # 保持与原先pil_image.save(output_path)相同的JPEG编码参数
+        pil_image.save(output_path, 'JPEG', optimize=False)
+    elif image_ext == 'png':
+        pil_image.save(output_path, 'PNG', optimize=False, compress_level=1)
+    else:
+        # jpx/jb2/pnm等扩展名与Pillow格式名不一致,由文件扩展名推断格式
+        pil_image.save(output_path)
+
 def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, extract_ir=False, pdf_index=1):
     """
     从PDF提取图像，如果是FFA则保存，可选择是否提取IR
@@ -224,10 +251,18 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
     pdf_path = Path(pdf_path)
     output_dir = Path(output_dir)
     
+    # 只打开一次PDF，类型分析和图像提取共用同一个文档对象
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        print(f"  警告: 无法分析PDF - {e}")
+        return {'status': 'error', 'message': '无法判断PDF类型'}
+    
     # 分析PDF类型和眼别
-    pdf_info = analyze_pdf_info(pdf_path, brightness_threshold)
+    pdf_info = analyze_pdf_info(pdf_path, brightness_threshold, doc=doc)
     
     if pdf_info is None:
+        doc.close()
         return {'status': 'error', 'message': '无法判断PDF类型'}
     
     # 判断是否需要跳过
@@ -235,6 +270,7 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
     
     # 跳过ICGA
     if pdf_type == 'ICGA':
+        doc.close()
         return {
             'status': 'skipped', 
             'type': 'ICGA', 
@@ -244,6 +280,7 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
     
     # 跳过纯IR（如果不提取IR）
     if pdf_type == 'IR' and not extract_ir:
+        doc.close()
         return {
             'status': 'skipped',
             'type': 'IR',
@@ -255,6 +292,7 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
     if (not pdf_info['has_ffa'] and
         not (extract_ir and pdf_info['has_ir']) and
         not pdf_info.get('eye_selected_label')):
+        doc.close()
         return {
             'status': 'skipped',
             'type': pdf_type,
@@ -265,16 +303,17 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
     # 提取图像
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    doc = fitz.open(pdf_path)
-    
     images_info = []
     total_images = 0
     
     for page_num in range(len(doc)):
         page = doc[page_num]
         image_list = page.get_images()
+        # 没有图像的页面（封面、纯文字页）不会输出任何图片，跳过开销最大的dict文本解析
+        if not image_list:
+            continue
         page_mid_x = page.rect.width / 2
-        
+
         text_dict = page.get_text("dict")
         timestamp_entries = []
         eye_by_column = defaultdict(lambda: {"eye": "未知", "strength": "weak"})
@@ -352,16 +391,23 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
         
         stripes_by_column = defaultdict(list)
         standard_candidates = []
-        
+        # 同一xref在页面中出现多次时，get_image_rects已返回它的全部位置，
+        # 重复处理只会再解码一次并产生重复候选，因此每个xref只处理一次
+        seen_xrefs = set()
+
         for img_index, img in enumerate(image_list):
             xref = img[0]
+            if xref in seen_xrefs:
+                continue
+            seen_xrefs.add(xref)
             base_image = doc.extract_image(xref)
             image_bytes = base_image["image"]
             image_ext = base_image["ext"]
             
             try:
-                pil_image = Image.open(io.BytesIO(image_bytes))
-                width, height = pil_image.size
+                # 尺寸直接取自extract_image返回的元数据，不需要先用PIL打开
+                width = base_image["width"]
+                height = base_image["height"]
                 
                 img_rects = page.get_image_rects(xref)
                 if not img_rects:
@@ -375,6 +421,12 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
                     min_height = 180
                 
                 is_stripe_candidate = width > 1000 and height < 120
+                is_standard_candidate = width >= min_width and height >= min_height
+                if not is_stripe_candidate and not is_standard_candidate:
+                    continue
+                
+                # 条带图像之后会从PDF页面重新渲染，只有标准图像需要解码
+                pil_image = None if is_stripe_candidate else Image.open(io.BytesIO(image_bytes))
                 
                 for img_rect in img_rects:
                     column_num = 1 if (img_rect.x0 + img_rect.x1) / 2 < page_mid_x else 2
@@ -382,13 +434,13 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
                     if is_stripe_candidate:
                         stripes_by_column[column_num].append({
                             "rect": img_rect,
-                            "pil_image": pil_image,
                             "ext": image_ext
                         })
-                    elif width >= min_width and height >= min_height:
+                    else:
                         standard_candidates.append({
                             "rect": img_rect,
                             "pil_image": pil_image,
+                            "image_bytes": image_bytes,
                             "ext": image_ext,
                             "column": column_num
                         })
@@ -445,7 +497,11 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
                     output_name = f"{eye_str}_pdf{pdf_index}_page{page_num+1}_img{next_index}{combine_suffix}.{candidate['ext']}"
                 
                 output_path = output_dir / output_name
-                pil_image.save(output_path)
+                if is_combined:
+                    save_image_no_optimize(pil_image, output_path, candidate['ext'])
+                else:
+                    # 未做任何变换时直接写出PDF内嵌的原始图像数据,无需重新编码
+                    output_path.write_bytes(candidate['image_bytes'])
                 
                 total_images += 1
                 images_info.append({
@@ -520,7 +576,11 @@ def extract_ffa_images_from_pdf(pdf_path, output_dir, brightness_threshold=80, e
                 )
 
                 output_path = output_dir / output_name
-                pil_image.save(output_path)
+                if is_combined:
+                    save_image_no_optimize(pil_image, output_path, 'png')
+                else:
+                    # 渲染得到的PNG数据未经变换,直接写出
+                    output_path.write_bytes(pix_bytes)
                 
                 total_images += 1
                 images_info.append({
@@ -7,52 +7,115 @@
 
 import os
 import re
+import csv
+import multiprocessing
 from pathlib import Path
 from PIL import Image
 import pandas as pd
 from datetime import datetime
 import numpy as np
+import cv2
 import easyocr
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
-def extract_bottom_region(image_path, bottom_pixels=80):
+try:
+    import tifffile  # 可选：未压缩TIFF可直接内存映射，只读取底部几行
+except ImportError:
+    tifffile = None
+
+# 每次送入EasyOCR的底部区域数量（readtext_batched批大小）
+OCR_BATCH_SIZE = 16
+
+# 元数据条只包含日期、眼别和质量评分，限制识别字符集并关闭段落合并等额外版面处理
+OCR_OPTIONS = {
+    'detail': 0,
+    'allowlist': '0123456789/-:.QOSDU ',
+    'paragraph': False,
+    'width_ths': 0.5,
+    'mag_ratio': 1.0,
+}
+
+# 底部区域送入OCR前的缩小倍数（元数据文字为白底黑字/黑底白字，缩小后再二值化不影响识别）
+OCR_DOWNSCALE = 2
+
+# 预读底部区域的线程数（磁盘读取/解码与OCR重叠）
+PREFETCH_WORKERS = 8
+
+# CPU模式下的OCR进程数（每个进程一个独立的EasyOCR reader；PyTorch推理需用进程而非线程并行）
+CPU_COUNT = os.cpu_count() or 1
+DEFAULT_OCR_WORKERS = max(1, min(8, CPU_COUNT))
+CONFIGURED_OCR_WORKERS = os.environ.get('OCR_WORKERS')
+try:
+    OCR_WORKERS = int(CONFIGURED_OCR_WORKERS) if CONFIGURED_OCR_WORKERS else DEFAULT_OCR_WORKERS
+except ValueError:
+    OCR_WORKERS = DEFAULT_OCR_WORKERS
+OCR_WORKERS = max(1, OCR_WORKERS)
+
+# 结果CSV的列（逐行写入，中断后可续跑）
+CSV_FIELDNAMES = [
+    'image_path', 'disease', 'patient_folder', 'filename',
+    'extracted_date', 'extracted_eye', 'quality_score',
+    'ocr_text', 'success', 'error',
+    'file_mtime_ns', 'file_size',
+]
+
+# OCR工作进程内的reader（由init_worker_reader初始化）
+worker_reader = None
+
+# 常见日期格式（模块加载时编译一次），以及匹配后按顺序尝试的strptime格式
+# （分隔符统一为'/'后再解析；年份在后时优先按美式MM/DD/YYYY，无效时再按DD/MM/YYYY）
+DATE_PATTERNS = [
+    (re.compile(r'\d{4}[/\-]\d{1,2}[/\-]\d{1,2}'), ('%Y/%m/%d',)),               # 2024/1/15 或 2024-01-15
+    (re.compile(r'\d{1,2}[/\-]\d{1,2}[/\-]\d{4}'), ('%m/%d/%Y', '%d/%m/%Y')),   # 01-15-2024 或 15/1/2024
+]
+
+# 图像质量评分：Q: XX 或 Q:XX
+QUALITY_RE = re.compile(r'Q:\s*(\d+)')
+
+# 眼别标识：OS/O.S、OD/O.D、OU/O.U（匹配大写文本）
+EYE_RE = re.compile(r'O\.?([SDU])')
+
+def extract_bottom_array(image_path, bottom_pixels=80):
     """
-    提取图像底部区域（包含日期等元数据）
+    提取图像底部区域（包含日期等元数据），返回uint8 numpy数组（灰度或RGB/RGBA）
+    
+    OCR只需要底部bottom_pixels行：未压缩的8位TIFF通过tifffile内存映射直接切片，
+    不解码整幅图像；其他情况（压缩TIFF、未安装tifffile）退回PIL整图解码后裁剪
     """
+    if tifffile is not None:
+        try:
+            arr = tifffile.memmap(image_path, mode='r')
+        except Exception:
+            arr = None  # 压缩TIFF或非TIFF文件无法内存映射
+        if (arr is not None and arr.dtype == np.uint8 and
+                (arr.ndim == 2 or (arr.ndim == 3 and arr.shape[-1] in (3, 4)))):
+            return np.array(arr[-bottom_pixels:])
+    
     img = Image.open(image_path)
     width, height = img.size
     
     # 提取底部区域
     bottom_region = img.crop((0, height - bottom_pixels, width, height))
-    return bottom_region
+    if bottom_region.mode not in ('L', 'RGB', 'RGBA'):
+        bottom_region = bottom_region.convert('L')
+    return np.asarray(bottom_region)
 
 def parse_date_from_text(text):
     """
     从OCR识别的文字中提取日期
     支持多种日期格式
     """
-    # 常见日期格式
-    date_patterns = [
-        r'(\d{4})[/\-](\d{1,2})[/\-](\d{1,2})',  # 2024/1/15 或 2024-01-15
-        r'(\d{1,2})[/\-](\d{1,2})[/\-](\d{4})',  # 15/1/2024 或 01-15-2024
-    ]
-    
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
+    for pattern, formats in DATE_PATTERNS:
+        match = pattern.search(text)
         if match:
-            try:
-                groups = match.groups()
-                if len(groups[0]) == 4:  # YYYY/MM/DD
-                    year, month, day = groups
-                else:  # DD/MM/YYYY or MM/DD/YYYY
-                    # 假设是 MM/DD/YYYY 格式（美式）
-                    month, day, year = groups
-                
-                # 验证日期有效性
-                date_obj = datetime(int(year), int(month), int(day))
-                return date_obj.strftime('%Y-%m-%d')
-            except ValueError:
-                continue
+            date_str = match.group(0).replace('-', '/')
+            # strptime同时完成解析和日期有效性验证，第一个成功的格式即返回
+            for fmt in formats:
+                try:
+                    return datetime.strptime(date_str, fmt).strftime('%Y-%m-%d')
+                except ValueError:
+                    continue
     
     return None
 
@@ -60,13 +123,14 @@ def extract_eye_label(text):
     """
     从文字中提取眼别标识
     """
-    text_upper = text.upper()
+    # 一次正则扫描收集出现过的标识，再按 OS > OD > OU 的优先级返回
+    found = set(EYE_RE.findall(text.upper()))
     
-    if 'OS' in text_upper or 'O.S' in text_upper:
+    if 'S' in found:
         return 'L'  # OS = Left eye
-    elif 'OD' in text_upper or 'O.D' in text_upper:
+    elif 'D' in found:
         return 'R'  # OD = Right eye
-    elif 'OU' in text_upper or 'O.U' in text_upper:
+    elif 'U' in found:
         return 'B'  # OU = Both eyes
     
     return None
@@ -75,53 +139,195 @@ def extract_quality_score(text):
     """
     从文字中提取图像质量评分
     """
-    # 查找 Q: XX 或 Q:XX 格式
-    match = re.search(r'Q:\s*(\d+)', text)
+    match = QUALITY_RE.search(text)
     if match:
         return int(match.group(1))
     return None
 
-def process_single_image(image_path, reader):
+def load_bottom_array(image_path, bottom_pixels=80):
     """
-    处理单张图像，提取元数据
+    读取图像底部区域，缩小并二值化为uint8 numpy数组（EasyOCR输入）
+    
+    CRAFT检测的计算量与H*W成正比，缩小OCR_DOWNSCALE倍可减少约3/4计算；
+    Otsu二值化提高文字对比度，弥补缩小带来的模糊
+    """
+    arr = extract_bottom_array(image_path, bottom_pixels)
+    
+    # 转换为灰度以提高OCR准确率（全程保持uint8数组，由OpenCV完成转换/缩放，不经过PIL中转）
+    if arr.ndim == 3:
+        code = cv2.COLOR_RGBA2GRAY if arr.shape[-1] == 4 else cv2.COLOR_RGB2GRAY
+        gray = cv2.cvtColor(arr, code)
+    else:
+        gray = arr
+    if OCR_DOWNSCALE > 1:
+        height, width = gray.shape
+        gray = cv2.resize(
+            gray,
+            (max(1, width // OCR_DOWNSCALE), max(1, height // OCR_DOWNSCALE)),
+            interpolation=cv2.INTER_LINEAR
+        )
+    
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binary
+
+def pad_bottom_array(bottom_array, height, width):
+    """
+    将底部区域用边缘像素填充到统一尺寸，便于批量送入EasyOCR
+    """
+    pad_h = height - bottom_array.shape[0]
+    pad_w = width - bottom_array.shape[1]
+    if pad_h == 0 and pad_w == 0:
+        return bottom_array
+    return np.pad(bottom_array, ((0, pad_h), (0, pad_w)), mode='edge')
+
+def parse_ocr_text(full_text):
+    """
+    从OCR合并文字中提取日期、眼别和质量评分
+    """
+    return {
+        'success': True,
+        'date': parse_date_from_text(full_text),
+        'eye': extract_eye_label(full_text),
+        'quality': extract_quality_score(full_text),
+        'raw_text': full_text
+    }
+
+def try_load_bottom_array(image_path):
+    """
+    读取底部区域，失败时不抛异常
+    
+    Returns:
+        (bottom_array, None) 或 (None, 错误信息)
     """
     try:
-        # 提取底部区域
-        bottom_region = extract_bottom_region(image_path)
-        
-        # 转换为灰度以提高OCR准确率
-        bottom_region_gray = bottom_region.convert('L')
-        
-        # 转换为numpy数组（EasyOCR要求）
-        bottom_array = np.array(bottom_region_gray)
-        
-        # 使用EasyOCR识别文字
-        # 注意：第一次运行会下载模型，需要一些时间
-        result = reader.readtext(bottom_array, detail=0)
-        
-        # 合并所有识别的文字
-        full_text = ' '.join(result)
-        
-        # 提取信息
-        date_str = parse_date_from_text(full_text)
-        eye_label = extract_eye_label(full_text)
-        quality_score = extract_quality_score(full_text)
-        
-        return {
-            'success': True,
-            'date': date_str,
-            'eye': eye_label,
-            'quality': quality_score,
-            'raw_text': full_text
-        }
-        
+        return load_bottom_array(image_path), None
     except Exception as e:
-        return {
-            'success': False,
-            'error': str(e)
-        }
+        return None, str(e)
 
-def batch_extract_metadata(dataset_path, output_csv):
+def ocr_loaded_batch(loaded, reader, batch_size=OCR_BATCH_SIZE):
+    """
+    对已读取的一组底部区域做批量OCR：填充到统一尺寸后一次调用readtext_batched，
+    摊薄检测/识别网络的调用开销
+    
+    Args:
+        loaded: try_load_bottom_array的返回值列表
+    
+    Returns:
+        list: 与loaded一一对应的元数据字典
+    """
+    metadata_list = [None] * len(loaded)
+    bottom_arrays = []
+    batch_indices = []
+    
+    for i, (bottom_array, error) in enumerate(loaded):
+        if bottom_array is None:
+            metadata_list[i] = {'success': False, 'error': error}
+        else:
+            bottom_arrays.append(bottom_array)
+            batch_indices.append(i)
+    
+    if bottom_arrays:
+        height = max(arr.shape[0] for arr in bottom_arrays)
+        width = max(arr.shape[1] for arr in bottom_arrays)
+        batch = [pad_bottom_array(arr, height, width) for arr in bottom_arrays]
+        
+        try:
+            batch_results = reader.readtext_batched(
+                batch, n_width=width, n_height=height, batch_size=batch_size, **OCR_OPTIONS
+            )
+        except Exception as e:
+            for i in batch_indices:
+                metadata_list[i] = {'success': False, 'error': str(e)}
+        else:
+            for i, result in zip(batch_indices, batch_results):
+                metadata_list[i] = parse_ocr_text(' '.join(result))
+    
+    return metadata_list
+
+def process_image_batch(image_paths, reader, batch_size=OCR_BATCH_SIZE):
+    """
+    批量处理一组图像（读取 + 批量OCR）
+    
+    Returns:
+        list: 与image_paths一一对应的元数据字典
+    """
+    loaded = [try_load_bottom_array(image_path) for image_path in image_paths]
+    return ocr_loaded_batch(loaded, reader, batch_size)
+
+def is_gpu_available(use_gpu=True):
+    """
+    判断是否可以使用GPU：use_gpu为True且CUDA可用；
+    CUDA_VISIBLE_DEVICES显式设为空时视为禁用GPU
+    """
+    import torch
+    return (
+        use_gpu
+        and os.environ.get('CUDA_VISIBLE_DEVICES') != ''
+        and torch.cuda.is_available()
+    )
+
+def create_ocr_reader(use_gpu=True):
+    """
+    创建EasyOCR reader（仅英文和数字，更快）
+    
+    GPU可用时使用GPU并开启cudnn_benchmark，否则退回CPU
+    
+    Returns:
+        (reader, 是否使用GPU)
+    """
+    gpu_available = is_gpu_available(use_gpu)
+    if gpu_available:
+        import torch
+        torch.backends.cudnn.benchmark = True
+    reader = easyocr.Reader(['en'], gpu=gpu_available, cudnn_benchmark=gpu_available)
+    return reader, gpu_available
+
+def warmup_ocr_reader(reader, height, width, batch_size=OCR_BATCH_SIZE, rounds=2):
+    """
+    用与正式批次相同尺寸的空白图像预热reader
+    
+    开启cudnn_benchmark后，首次遇到新的输入尺寸时cuDNN会花数秒挑选卷积算法；
+    预热可避免这段停顿计入第一批图像，并让cuDNN按实际批次尺寸选择算法
+    """
+    dummy_batch = [np.zeros((height, width), dtype=np.uint8)] * batch_size
+    for _ in range(rounds):
+        reader.readtext_batched(dummy_batch, n_width=width, n_height=height,
+                                batch_size=batch_size, **OCR_OPTIONS)
+
+def init_worker_reader(torch_threads):
+    """
+    OCR工作进程初始化：每个进程创建自己的CPU reader，
+    并限制PyTorch线程数，避免多个进程争抢同一批核心
+    """
+    global worker_reader
+    import torch
+    torch.set_num_threads(torch_threads)
+    worker_reader = easyocr.Reader(['en'], gpu=False, verbose=False)
+
+def process_image_batch_in_worker(image_paths):
+    """
+    在OCR工作进程中处理一组图像（只传路径，reader不需要跨进程序列化）
+    """
+    return process_image_batch(image_paths, worker_reader)
+
+def iter_prefetched_batches(chunks, reader):
+    """
+    单reader顺序OCR各批次，同时用线程池预读下一批底部区域
+    （PIL/numpy解码会释放GIL，可与当前批次的OCR重叠进行）
+    
+    Yields:
+        每个批次的元数据字典列表
+    """
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        next_loads = [executor.submit(try_load_bottom_array, img_info['path']) for img_info in chunks[0]] if chunks else []
+        for chunk_idx in range(len(chunks)):
+            loaded = [future.result() for future in next_loads]
+            if chunk_idx + 1 < len(chunks):
+                next_loads = [executor.submit(try_load_bottom_array, img_info['path'])
+                              for img_info in chunks[chunk_idx + 1]]
+            yield ocr_loaded_batch(loaded, reader)
+
+def batch_extract_metadata(dataset_path, output_csv, use_gpu=True):
     """
     批量提取数据集中所有OCT图像的元数据
     """
@@ -130,12 +336,6 @@ def batch_extract_metadata(dataset_path, output_csv):
     print("="*70)
     print()
     
-    # 初始化EasyOCR（仅英文和数字，更快）
-    print("初始化OCR引擎...")
-    print("(第一次运行会下载模型文件，请稍候...)")
-    reader = easyocr.Reader(['en'], gpu=False)
-    print("✓ OCR引擎初始化完成\n")
-    
     # 收集所有TIFF图像
     dataset_path = Path(dataset_path)
     diseases = ['葡萄膜炎', '正常', 'DR', 'AMD', 'CSC', 'RVO']
@@ -155,44 +355,120 @@ def batch_extract_metadata(dataset_path, output_csv):
                 continue
             
             for img_file in oct_folder.glob("*.tif"):
+                st = img_file.stat()
                 all_images.append({
                     'path': str(img_file),
                     'disease': disease,
                     'patient_folder': patient_folder.name,
-                    'filename': img_file.name
+                    'filename': img_file.name,
+                    'file_mtime_ns': str(st.st_mtime_ns),
+                    'file_size': str(st.st_size)
                 })
     
-    print(f"找到 {len(all_images)} 张OCT图像\n")
+    print(f"找到 {len(all_images)} 张OCT图像")
     
-    # 批量处理
-    results = []
-    for img_info in tqdm(all_images, desc="提取元数据"):
-        metadata = process_single_image(img_info['path'], reader)
-        
-        result = {
-            'image_path': img_info['path'],
-            'disease': img_info['disease'],
-            'patient_folder': img_info['patient_folder'],
-            'filename': img_info['filename'],
-            'extracted_date': metadata.get('date'),
-            'extracted_eye': metadata.get('eye'),
-            'quality_score': metadata.get('quality'),
-            'ocr_text': metadata.get('raw_text', ''),
-            'success': metadata.get('success', False),
-            'error': metadata.get('error', '')
-        }
-        results.append(result)
-    
-    # 保存结果
-    df = pd.DataFrame(results)
-    df.to_csv(output_csv, index=False, encoding='utf-8-sig')
+    # 增量处理/断点续跑：输出CSV中(路径, 修改时间, 文件大小)都未变化的图像直接复用已有结果
+    cached_rows = {}
+    if os.path.exists(output_csv):
+        with open(output_csv, 'r', encoding='utf-8-sig', newline='') as f:
+            cached_rows = {row['image_path']: row for row in csv.DictReader(f)}
+    
+    kept_rows = []
+    pending_images = []
+    for img_info in all_images:
+        cached = cached_rows.get(img_info['path'])
+        if (cached is not None and
+                cached.get('file_mtime_ns') == img_info['file_mtime_ns'] and
+                cached.get('file_size') == img_info['file_size']):
+            kept_rows.append(cached)
+        else:
+            pending_images.append(img_info)
+    all_images = pending_images
+    if kept_rows:
+        print(f"复用已有结果 {len(kept_rows)} 张，需要处理 {len(all_images)} 张")
+    print()
+    
+    # 批量处理（每OCR_BATCH_SIZE张图像一次批量OCR）
+    chunks = [all_images[i:i + OCR_BATCH_SIZE] for i in range(0, len(all_images), OCR_BATCH_SIZE)]
+    
+    # 初始化EasyOCR
+    print("初始化OCR引擎...")
+    print("(第一次运行会下载模型文件，请稍候...)")
+    gpu_enabled = is_gpu_available(use_gpu)
+    worker_count = 1 if gpu_enabled else min(OCR_WORKERS, len(chunks) or 1)
+    
+    if worker_count > 1:
+        # CPU模式：多个进程各自持有一个reader，按批次分片并行OCR
+        print(f"✓ OCR引擎使用CPU，并行进程数: {worker_count}\n")
+        torch_threads = max(1, CPU_COUNT // worker_count)
+        pool = multiprocessing.Pool(processes=worker_count, initializer=init_worker_reader,
+                                    initargs=(torch_threads,))
+        chunk_results = pool.imap(process_image_batch_in_worker,
+                                  [[img_info['path'] for img_info in chunk] for chunk in chunks])
+    else:
+        reader, gpu_enabled = create_ocr_reader(use_gpu=use_gpu)
+        if gpu_enabled and chunks:
+            # 以第一张图像的底部区域尺寸预热（同一设备导出的图像尺寸一致）
+            first_array, _ = try_load_bottom_array(chunks[0][0]['path'])
+            if first_array is not None:
+                print("预热OCR引擎...")
+                warmup_ocr_reader(reader, *first_array.shape)
+        print(f"✓ OCR引擎初始化完成（{'GPU' if gpu_enabled else 'CPU'}）\n")
+        pool = None
+        chunk_results = iter_prefetched_batches(chunks, reader)
+    
+    # 重写CSV：先写入复用的结果（丢弃已变化或已删除的图像），再逐批写入新结果并刷新，
+    # 中断时已处理的结果不会丢失
+    csv_file = open(output_csv, 'w', encoding='utf-8-sig', newline='')
+    writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDNAMES, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(kept_rows)
+    csv_file.flush()
+    
+    try:
+        with tqdm(total=len(all_images), desc="提取元数据") as pbar:
+            for chunk, metadata_list in zip(chunks, chunk_results):
+                for img_info, metadata in zip(chunk, metadata_list):
+                    result = {
+                        'image_path': img_info['path'],
+                        'disease': img_info['disease'],
+                        'patient_folder': img_info['patient_folder'],
+                        'filename': img_info['filename'],
+                        'extracted_date': metadata.get('date'),
+                        'extracted_eye': metadata.get('eye'),
+                        'quality_score': metadata.get('quality'),
+                        'ocr_text': metadata.get('raw_text', ''),
+                        'success': metadata.get('success', False),
+                        'error': metadata.get('error', ''),
+                        'file_mtime_ns': img_info['file_mtime_ns'],
+                        'file_size': img_info['file_size']
+                    }
+                    writer.writerow(result)
+                csv_file.flush()
+                pbar.update(len(chunk))
+    finally:
+        csv_file.close()
+        # 结果已全部取回或被中断时，直接结束工作进程
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    
+    # 读取完整结果（含之前运行已处理的部分）
+    df = pd.read_csv(output_csv, encoding='utf-8-sig')
     
     # 统计报告
     print("\n" + "="*70)
     print("提取结果统计")
     print("="*70)
     
-    success_count = df['success'].sum()
+    # 一次聚合得到各项计数（count只统计非空值）
+    counts = df.agg({
+        'success': 'sum',
+        'extracted_date': 'count',
+        'extracted_eye': 'count',
+        'quality_score': 'count',
+    })
+    success_count = counts['success']
     total_count = len(df)
     
     print(f"总图像数: {total_count}")
@@ -201,15 +477,15 @@ def batch_extract_metadata(dataset_path, output_csv):
     print()
     
     # 日期提取统计
-    date_count = df['extracted_date'].notna().sum()
+    date_count = counts['extracted_date']
     print(f"成功提取日期: {date_count} ({date_count/total_count*100:.1f}%)")
     
     # 眼别提取统计
-    eye_count = df['extracted_eye'].notna().sum()
+    eye_count = counts['extracted_eye']
     print(f"成功提取眼别: {eye_count} ({eye_count/total_count*100:.1f}%)")
     
     # 质量评分提取统计
-    quality_count = df['quality_score'].notna().sum()
+    quality_count = counts['quality_score']
     print(f"成功提取质量评分: {quality_count} ({quality_count/total_count*100:.1f}%)")
     
     print()
@@ -17,10 +17,17 @@ import pandas as pd
 from datetime import datetime
 import fitz  # PyMuPDF
 from PIL import Image
+import numpy as np
 import io
 import re
 import shutil
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import functools
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# 可选: 安装了python-calamine(Rust实现的xlsx读取, 比openpyxl快一个数量级)时优先使用
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') is not None else 'openpyxl'
 
 CPU_COUNT = os.cpu_count() or 1
 DEFAULT_WORKERS = max(1, min(8, CPU_COUNT))
@@ -31,9 +38,35 @@ except ValueError:
     UV_WORKERS = DEFAULT_WORKERS
 UV_WORKERS = max(1, UV_WORKERS)
 
+# 同一PDF中逐张OCR失败达到该数量后,剩余图像不再逐张OCR(只用页面级兜底)
+OCR_MAX_FAILED_IMAGES = 3
+
+# 默认OCT文件夹关键词（按优先级），以及用于一次性筛选候选文件夹的预编译正则
+DEFAULT_OCT_KEYWORDS = ['科林', '视微', '海德堡', 'OCT']
+OCT_FOLDER_RE = re.compile('|'.join(DEFAULT_OCT_KEYWORDS))
+
+# 文件夹名中Windows/Linux不允许的字符
+INVALID_FILENAME_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+
+# 月份文件夹范围格式，如 "1-2", "1--2", "10-12"
+MONTH_RANGE_RE = re.compile(r'^\s*(\d+)\s*-+\s*(\d+)\s*(?:-|$)')
+
+# 就诊日期字段中的日期部分(YYYY-MM-DD)
+VISIT_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
 # 导入FFA提取功能
 sys.path.append('/data2/xuhanyang/眼科大模型')
 from extract_ffa_only import extract_ffa_images_from_pdf
+# OCR眼别识别的公共函数与extract_csc_images.py共用同一份实现
+from extract_csc_images import (
+    find_pdf_files,
+    init_ocr_worker,
+    get_ocr_reader,
+    parse_eye_from_ocr_results,
+    pad_ocr_arrays,
+    enhance_contrast,
+    pil_to_ocr_array,
+)
 
 
 def parse_patient_folder(folder_str):
@@ -75,14 +108,65 @@ def parse_visit_date(date_str):
     eye_type = "单眼" if "单眼" in date_str else ("双眼" if "双眼" in date_str else "")
 
     # 提取日期部分
-    date_match = re.search(r'(\d{4}-\d{2}-\d{2})', date_str)
+    date_match = VISIT_DATE_RE.search(date_str)
     if date_match:
-        date_part = date_match.group(1)
+        date_part = date_match.group(0)
         return date_part, eye_type
 
     return None, eye_type
 
 
+@functools.lru_cache(maxsize=4096)
+def list_subdirs(folder_str):
+    """
+    列出文件夹下的所有子文件夹名(按路径缓存)
+    同一病例按不同OCT关键词多次查找时, 年份/月份/日期目录只读取一次, 之后只做内存中的关键词过滤
+    使用os.scandir: 目录项自带类型信息, 不需要逐项stat, 也不为每一项构造Path
+
+    Returns:
+        子文件夹名元组; 文件夹不存在或无权限时返回空元组
+    """
+    try:
+        with os.scandir(folder_str) as it:
+            return tuple(entry.name for entry in it if entry.is_dir())
+    except OSError:
+        return ()
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_month_folder(month_name):
+    """
+    解析月份文件夹名(按名称缓存, 每个月份文件夹只解析一次)
+
+    Returns:
+        (digits, month_range):
+        - digits: 纯数字名称, 如 "3"、"123"(连写表示1、2、3月), 否则为None
+        - month_range: 范围格式 "1-3"、"10--12" 解析出的 (start_month, end_month), 否则为None
+    """
+    if month_name.isdigit():
+        return month_name, None
+    range_match = MONTH_RANGE_RE.match(month_name)
+    if range_match:
+        return None, (int(range_match.group(1)), int(range_match.group(2)))
+    return None, None
+
+
+def month_folder_matches(month_name, target_month):
+    """判断月份文件夹是否包含目标月份"""
+    digits, month_range = parse_month_folder(month_name)
+    if digits is not None:
+        # 单个数字 "3" 或连写数字 "123"
+        return str(target_month) in digits
+    if month_range is not None:
+        start_month, end_month = month_range
+        if start_month <= end_month:
+            # 正常范围，如 1-3, 4-6, 10-12
+            return start_month <= target_month <= end_month
+        # 跨年范围，如 12-1 (12月到1月)
+        return target_month >= start_month or target_month <= end_month
+    return False
+
+
 def find_exam_folders(base_path, patient_id, visit_date, exam_keyword):
     """
     查找所有匹配的检查文件夹(支持多个文件夹,如血流模式和普通模式)
@@ -98,20 +182,13 @@ def find_exam_folders(base_path, patient_id, visit_date, exam_keyword):
     found_folders = []
     # 情况1: 如果提供了 patient_path，先尝试在该路径下查找
     # 但如果找不到，还是要根据日期的月份在正确的月份文件夹下查找
-    if base_path:
-        patient_root = Path(str(base_path))
-        if patient_root.exists() and visit_date:
-            date_folder = patient_root / visit_date
-            if date_folder.exists():
-                try:
-                    for item in date_folder.iterdir():
-                        if item.is_dir() and exam_keyword in item.name:
-                            found_folders.append(item)
-                except PermissionError:
-                    pass
-            # 如果找到了，直接返回
-            if found_folders:
-                return found_folders
+    if base_path and visit_date:
+        # 日期文件夹不存在时list_subdirs返回空元组
+        date_folder = Path(str(base_path)) / visit_date
+        found_folders = [date_folder / name for name in list_subdirs(str(date_folder)) if exam_keyword in name]
+        # 如果找到了，直接返回
+        if found_folders:
+            return found_folders
         # 如果patient_path下找不到，继续用情况2的逻辑（根据日期月份查找）
 
     # 情况2: 根据日期月份+patient_id 方式搜索（无论是否有patient_path，如果情况1失败都会执行这里）
@@ -132,18 +209,8 @@ def find_exam_folders(base_path, patient_id, visit_date, exam_keyword):
     ]
 
     for base in possible_bases:
-        year_root = Path(base)
-        if not year_root.exists():
-            continue
-
-        # 获取所有月份文件夹
-        month_folders = []
-        try:
-            for item in year_root.iterdir():
-                if item.is_dir():
-                    month_folders.append(item)
-        except PermissionError:
-            continue
+        # 获取所有月份文件夹(年份目录不存在时为空)
+        month_folders = [Path(base) / name for name in list_subdirs(base)]
         
         if not month_folders:
             continue
@@ -151,47 +218,12 @@ def find_exam_folders(base_path, patient_id, visit_date, exam_keyword):
         # 根据月份构建查找顺序：先找目标月份，再找其他月份
         search_order = []
         if target_month:
-            # 先添加匹配目标月份的文件夹
-            for month_folder in month_folders:
-                month_name = month_folder.name
-                month_match = False
-                
-                # 方法1: 直接匹配单个数字，如 "1", "2", "3"
-                if month_name == str(target_month):
-                    month_match = True
-                
-                # 方法2: 匹配连在一起的数字，如 "123" 表示1、2、3月，"456" 表示4、5、6月
-                elif month_name.isdigit():
-                    if str(target_month) in month_name:
-                        month_match = True
-                
-                # 方法3: 匹配范围格式，如 "1-2", "1--2", "1-3", "10-12", "10--12"
-                elif '-' in month_name or '--' in month_name:
-                    # 提取范围的两个数字
-                    range_parts = re.split(r'-+', month_name)
-                    if len(range_parts) >= 2:
-                        try:
-                            start_month = int(range_parts[0])
-                            end_month = int(range_parts[1])
-                            # 检查目标月份是否在范围内（考虑跨年情况）
-                            if start_month <= end_month:
-                                # 正常范围，如 1-3, 4-6, 10-12
-                                if start_month <= target_month <= end_month:
-                                    month_match = True
-                            else:
-                                # 跨年范围，如 12-1 (12月到1月)
-                                if target_month >= start_month or target_month <= end_month:
-                                    month_match = True
-                        except ValueError:
-                            pass
-                
-                if month_match and month_folder not in search_order:
-                    search_order.append(month_folder)
-            
-            # 再添加其他月份文件夹
-            for month_folder in month_folders:
-                if month_folder not in search_order:
-                    search_order.append(month_folder)
+            # 先添加匹配目标月份的文件夹，再添加其他月份文件夹
+            matched = [month_folder for month_folder in month_folders
+                       if month_folder_matches(month_folder.name, target_month)]
+            others = [month_folder for month_folder in month_folders
+                      if not month_folder_matches(month_folder.name, target_month)]
+            search_order = matched + others
         else:
             # 如果无法解析月份，按原始顺序搜索
             search_order = month_folders
@@ -199,19 +231,15 @@ def find_exam_folders(base_path, patient_id, visit_date, exam_keyword):
         # 按顺序搜索月份文件夹
         for month_folder in search_order:
             # 在该月份文件夹下查找患者文件夹，使用patient_id
-            patient_folders = list(month_folder.glob(f'{patient_id}*'))
+            # 只对名称匹配的患者文件夹构造Path
+            patient_folders = [month_folder / name for name in list_subdirs(str(month_folder))
+                               if name.startswith(patient_id)]
             
             for patient_path in patient_folders:
                 date_folder = patient_path / visit_date
-                if not date_folder.exists():
-                    continue
-
-                try:
-                    for item in date_folder.iterdir():
-                        if item.is_dir() and exam_keyword in item.name:
-                            found_folders.append(item)
-                except PermissionError:
-                    continue
+                for name in list_subdirs(str(date_folder)):
+                    if exam_keyword in name:
+                        found_folders.append(date_folder / name)
 
             # 如果找到了，就不再搜索其他月份
             if found_folders:
@@ -236,7 +264,10 @@ def find_nearest_date_oct_folders(patient_id, visit_date, oct_keywords=None):
     from datetime import datetime as _dt
 
     if oct_keywords is None:
-        oct_keywords = ['科林', '视微', '海德堡', 'OCT']
+        oct_keywords = DEFAULT_OCT_KEYWORDS
+        oct_folder_re = OCT_FOLDER_RE
+    else:
+        oct_folder_re = re.compile('|'.join(re.escape(kw) for kw in oct_keywords))
 
     if not patient_id or not visit_date:
         return [], None, None, None
@@ -254,49 +285,30 @@ def find_nearest_date_oct_folders(patient_id, visit_date, oct_keywords=None):
     available_dates = []  # [(date_obj, date_str, oct_folders, oct_type), ...]
 
     for base in possible_bases:
-        base_path = Path(base)
-        if not base_path.exists():
-            continue
-
         # 同样考虑月份子目录: 年份/月份段/患者文件夹
-        # 获取所有月份文件夹
-        month_folders = []
-        try:
-            for item in base_path.iterdir():
-                if item.is_dir():
-                    month_folders.append(item)
-        except PermissionError:
-            continue
-        
-        # 在所有月份文件夹下查找患者
-        for month_folder in month_folders:
-            patient_folders = list(month_folder.glob(f'{patient_id}*'))
-            if not patient_folders:
-                continue
-
-            for patient_path in patient_folders:
-                try:
-                    for date_folder in patient_path.iterdir():
-                        if not date_folder.is_dir():
-                            continue
-
-                        date_str = date_folder.name
-                        try:
-                            date_obj = _dt.strptime(date_str, '%Y-%m-%d')
-                        except Exception:
-                            continue
-
-                        for oct_keyword in oct_keywords:
-                            oct_folders = []
-                            for item in date_folder.iterdir():
-                                if item.is_dir() and oct_keyword in item.name:
-                                    oct_folders.append(item)
-
-                            if oct_folders:
-                                available_dates.append((date_obj, date_str, oct_folders, oct_keyword))
-                                break
-                except PermissionError:
+        # 在所有月份文件夹下查找患者(目录列表来自list_subdirs缓存)
+        for month_name in list_subdirs(base):
+            month_path = os.path.join(base, month_name)
+            for patient_name in list_subdirs(month_path):
+                if not patient_name.startswith(patient_id):
                     continue
+                patient_path = os.path.join(month_path, patient_name)
+
+                for date_str in list_subdirs(patient_path):
+                    try:
+                        date_obj = _dt.strptime(date_str, '%Y-%m-%d')
+                    except Exception:
+                        continue
+
+                    # 只列一次子目录，用正则筛出候选，再按关键词优先级归类
+                    date_folder = os.path.join(patient_path, date_str)
+                    candidates = [name for name in list_subdirs(date_folder) if oct_folder_re.search(name)]
+                    for oct_keyword in oct_keywords:
+                        oct_folders = [Path(date_folder) / name for name in candidates if oct_keyword in name]
+
+                        if oct_folders:
+                            available_dates.append((date_obj, date_str, oct_folders, oct_keyword))
+                            break
 
         if available_dates:
             break
@@ -310,28 +322,38 @@ def find_nearest_date_oct_folders(patient_id, visit_date, oct_keywords=None):
     return nearest[2], nearest[1], nearest[3], days_diff
 
 
-# ---------------- OCR & OCT PDF 提取，与原脚本保持一致 ----------------
+def prefetch_month_listings(rows, max_workers=8):
+    """
+    在主进程中用线程池并行预读各病例日期所在年份下的月份目录列表, 填充list_subdirs缓存
+    (目录读取是I/O等待, 适合线程; 进程池以fork方式创建时工作进程直接继承已填充的缓存)
 
-_ocr_reader = None
+    Args:
+        rows: 病例记录(dict)列表
+        max_workers: 预读线程数
+    """
+    years = set()
+    for row in rows:
+        for column in ('oct_date', 'ffa_date', 'visit_date'):
+            date_part, _ = parse_visit_date(row.get(column, ''))
+            if date_part:
+                years.add(date_part[:4])
+
+    month_paths = []
+    for year in sorted(years):
+        base = f'/share/kongzitai/ophthalmology/E:/{year}'
+        month_paths.extend(os.path.join(base, name) for name in list_subdirs(base))
 
+    if month_paths:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(month_paths))) as executor:
+            list(executor.map(list_subdirs, month_paths))
 
-def get_ocr_reader(use_gpu=True):
-    """获取或创建OCR reader(单例模式)"""
-    global _ocr_reader
-    if _ocr_reader is None:
-        import easyocr
-        import torch
-        gpu_available = torch.cuda.is_available() and use_gpu
-        _ocr_reader = easyocr.Reader(['en'], gpu=gpu_available, verbose=False)
-    return _ocr_reader
+
+# ---------------- OCR & OCT PDF 提取，与原脚本保持一致 ----------------
 
 
 def detect_eye_from_oct_image(pil_image, use_gpu=True, try_extended_region=False):
     """与 extract_csc_images.py 中实现一致，略"""
     try:
-        import tempfile
-        from PIL import ImageEnhance
-
         width, height = pil_image.size
         reader = get_ocr_reader(use_gpu=use_gpu)
 
@@ -345,34 +367,35 @@ def detect_eye_from_oct_image(pil_image, use_gpu=True, try_extended_region=False
                 (0, 0, width, int(height * 0.15), "full_top"),
             ])
 
+        region_arrays = []
         for x1, y1, x2, y2, region_name in detection_regions:
             try:
                 region = pil_image.crop((x1, y1, x2, y2))
-                enhancer = ImageEnhance.Contrast(region)
-                region = enhancer.enhance(2.0)
-
-                with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                    region.save(tmp.name)
-                    tmp_path = tmp.name
-
-                results = reader.readtext(tmp_path)
-                Path(tmp_path).unlink()
-
-                text = ' '.join([result[1].upper() for result in results])
-                text = text.replace('0S', 'OS').replace('0D', 'OD')
-                text = text.replace('QS', 'OS').replace('QD', 'OD')
-
-                has_od = 'OD' in text or 'RIGHT' in text
-                has_os = 'OS' in text or 'LEFT' in text
-
-                if has_od and not has_os:
-                    return "_OD"
-                elif has_os and not has_od:
-                    return "_OS"
-                elif has_od and has_os:
-                    od_pos = text.find('OD') if 'OD' in text else (text.find('RIGHT') if 'RIGHT' in text else float('inf'))
-                    os_pos = text.find('OS') if 'OS' in text else (text.find('LEFT') if 'LEFT' in text else float('inf'))
-                    return "_OD" if od_pos < os_pos else "_OS"
+                # 增强对比度后直接使用内存中的数组,不经过临时PNG文件
+                region_arrays.append(pil_to_ocr_array(enhance_contrast(region, 2.0)))
+            except Exception:
+                continue
+
+        if getattr(reader, 'device', 'cpu') != 'cpu' and len(region_arrays) > 1:
+            # GPU: 所有区域填充到相同尺寸后一次批量OCR,按优先级取第一个识别成功的区域
+            try:
+                batch, batch_height, batch_width = pad_ocr_arrays(region_arrays)
+                batch_results = reader.readtext_batched(batch, n_width=batch_width, n_height=batch_height,
+                                                        batch_size=len(batch))
+                for results in batch_results:
+                    eye_label = parse_eye_from_ocr_results(results)
+                    if eye_label:
+                        return eye_label
+                return ""
+            except Exception:
+                pass  # 批量失败时退回逐个区域识别
+
+        # CPU: 逐个区域识别,第一个区域命中即返回,避免多余的检测计算
+        for region_array in region_arrays:
+            try:
+                eye_label = parse_eye_from_ocr_results(reader.readtext(region_array))
+                if eye_label:
+                    return eye_label
             except Exception:
                 continue
     except Exception:
@@ -383,38 +406,17 @@ def detect_eye_from_oct_image(pil_image, use_gpu=True, try_extended_region=False
 def detect_eye_from_pdf_page(page, use_gpu=False):
     """从PDF页面右上角识别眼别，保持与原实现一致"""
     try:
-        import tempfile
-
+        # 只以灰度渲染右上角区域 (90%-100%宽度, 0-8%高度), 2倍分辨率保证OCR准确率
+        rect = page.rect
+        clip = fitz.Rect(rect.x0 + rect.width * 0.90, rect.y0, rect.x1, rect.y0 + rect.height * 0.08)
         mat = fitz.Matrix(2.0, 2.0)
-        pix = page.get_pixmap(matrix=mat)
-        page_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-        width, height = page_img.size
-        right_top = page_img.crop((int(width * 0.90), 0, width, int(height * 0.08)))
-
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            right_top.save(tmp.name)
-            tmp_path = tmp.name
+        pix = page.get_pixmap(matrix=mat, clip=clip, colorspace=fitz.csGRAY, alpha=False)
+        # pixmap缓冲区即灰度像素, 直接建立numpy视图
+        right_top = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
 
         reader = get_ocr_reader(use_gpu=use_gpu)
-        results = reader.readtext(tmp_path)
-        Path(tmp_path).unlink()
-
-        text = ' '.join([result[1].upper() for result in results])
-        text = text.replace('0S', 'OS').replace('0D', 'OD')
-        text = text.replace('QS', 'OS').replace('QD', 'OD')
-
-        has_od = 'OD' in text or 'RIGHT' in text
-        has_os = 'OS' in text or 'LEFT' in text
-
-        if has_od and not has_os:
-            return "_OD"
-        elif has_os and not has_od:
-            return "_OS"
-        elif has_od and has_os:
-            od_pos = text.find('OD') if 'OD' in text else (text.find('RIGHT') if 'RIGHT' in text else float('inf'))
-            os_pos = text.find('OS') if 'OS' in text else (text.find('LEFT') if 'LEFT' in text else float('inf'))
-            return "_OD" if od_pos < os_pos else "_OS"
+        results = reader.readtext(right_top)
+        return parse_eye_from_ocr_results(results)
     except Exception:
         pass
     return ""
@@ -435,35 +437,30 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
         total_images = start_index - 1
         pdf_eye_label = cached_eye_label if cached_eye_label else None
         tried_pdf_page_render = False
+        ocr_fail_count = 0
+        # 同一图像(同一xref)可能在多页重复引用, 只提取一次
+        seen_xrefs = set()
 
         for page_num in range(len(doc)):
             page = doc[page_num]
             image_list = page.get_images()
 
-            text_dict = page.get_text("dict")
-            text_blocks = []
-            for block in text_dict["blocks"]:
-                if "lines" in block:
-                    for line in block["lines"]:
-                        for span in line["spans"]:
-                            text_content = span["text"].strip()
-                            if text_content:
-                                bbox = span["bbox"]
-                                text_blocks.append({
-                                    'text': text_content,
-                                    'x': bbox[0],
-                                    'y': bbox[1]
-                                })
-
             for img_index, img in enumerate(image_list):
                 xref = img[0]
+                # get_images返回 (xref, smask, width, height, ...), 先按尺寸过滤小图(标题图和logo),
+                # 无需取出图像数据; 个别PDF此处尺寸为0, 则在extract_image之后再判断
+                if 0 < img[2] < 300 or 0 < img[3] < 300:
+                    continue
+                if xref in seen_xrefs:
+                    continue
+                seen_xrefs.add(xref)
+
                 base_image = doc.extract_image(xref)
                 image_bytes = base_image["image"]
                 image_ext = base_image["ext"]
 
                 try:
-                    pil_image = Image.open(io.BytesIO(image_bytes))
-                    width, height = pil_image.size
+                    width, height = base_image["width"], base_image["height"]
 
                     if width < 300 or height < 300:
                         continue
@@ -473,9 +470,16 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
                     if pdf_eye_label:
                         eye_label = pdf_eye_label
                     else:
-                        eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=False)
-                        if not eye_label:
-                            eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=True)
+                        eye_label = ""
+                        # 前几张图像都识别失败时,后续图像大概率同样失败,不再逐张OCR
+                        if ocr_fail_count < OCR_MAX_FAILED_IMAGES:
+                            # 只有需要OCR识别眼别时才打开图像
+                            pil_image = Image.open(io.BytesIO(image_bytes))
+                            eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=False)
+                            if not eye_label:
+                                eye_label = detect_eye_from_oct_image(pil_image, use_gpu=use_gpu_ocr, try_extended_region=True)
+                            if not eye_label:
+                                ocr_fail_count += 1
 
                         if not eye_label and page_num == 0:
                             page_text = page.get_text()
@@ -502,8 +506,9 @@ def extract_oct_images_from_pdf(pdf_path, output_dir, start_index=1, folder_pref
                     else:
                         output_name = f"{eye_str}_{prefix_str}{pdf_str}main.{image_ext}"
 
+                    # 直接写出PDF内嵌的原始图像数据(扩展名即其格式),避免解码后再重新编码
                     output_path = output_dir / output_name
-                    pil_image.save(output_path)
+                    output_path.write_bytes(image_bytes)
 
                 except Exception as e:
                     print(f"    警告: 图像 {img_index + 1} 保存失败 - {e}")
@@ -596,7 +601,7 @@ def process_single_case(row, oct_type, output_base_dir, year):
     # 处理文件夹名中不允许的字符（替换为下划线）
     eye_part = patient_folder if patient_folder else ""
     # 替换文件夹名中不允许的字符
-    eye_part = re.sub(r'[<>:"/\\|?*]', '_', eye_part)  # 替换Windows/Linux不允许的字符
+    eye_part = INVALID_FILENAME_CHARS_RE.sub('_', eye_part)  # 替换Windows/Linux不允许的字符
     eye_part = eye_part.strip()  # 去除首尾空格
     
     # 创建输出文件夹: 姓名_patient_folder内容_日期(就诊日期)
@@ -692,7 +697,7 @@ def process_single_case(row, oct_type, output_base_dir, year):
                     folder_idx = oct_folders.index(oct_folder) + 1
                     folder_prefix = f"folder{folder_idx}"
 
-                oct_pdfs = sorted(list(oct_folder.rglob('*.pdf')) + list(oct_folder.rglob('*.PDF')))
+                oct_pdfs = sorted(find_pdf_files(oct_folder))
                 if oct_pdfs:
                     for pdf_idx, pdf in enumerate(oct_pdfs, 1):
                         num_images = extract_oct_images_from_pdf(
@@ -700,7 +705,7 @@ def process_single_case(row, oct_type, output_base_dir, year):
                             oct_output_dir,
                             start_index=image_counter,
                             folder_prefix=folder_prefix,
-                            use_gpu_ocr=False,
+                            use_gpu_ocr=True,
                             pdf_index=pdf_idx
                         )
                         result['oct_extracted'] += num_images
@@ -720,7 +725,7 @@ def process_single_case(row, oct_type, output_base_dir, year):
         result['ffa_found'] = True
         result['ffa_path'] = str(ffa_folder)
 
-        ffa_pdfs = list(ffa_folder.rglob('*.pdf')) + list(ffa_folder.rglob('*.PDF'))
+        ffa_pdfs = find_pdf_files(ffa_folder)
         if ffa_pdfs:
             for idx, pdf in enumerate(ffa_pdfs, 1):
                 extract_result = extract_ffa_images_from_pdf(pdf, ffa_output_dir, pdf_index=idx)
@@ -748,19 +753,47 @@ def process_single_case(row, oct_type, output_base_dir, year):
     return result
 
 
-def _process_case_worker(idx, row_dict, oct_type, output_base_dir_str, year):
+# 工作进程中的病例行数据(由init_case_worker在进程启动时设置一次)
+_worker_case_rows = None
+
+
+def init_case_worker(case_rows, worker_counter, torch_threads):
+    """
+    病例进程池的工作进程初始化: 保存全部病例行数据, 之后每个任务只需传递行号
+    (行数据随进程启动传入一次, 不再随每个任务重复序列化), 再完成OCR相关初始化
+    """
+    global _worker_case_rows
+    _worker_case_rows = case_rows
+    init_ocr_worker(worker_counter, torch_threads)
+    # 预先加载OCR模型, 不落在每个进程处理第一个病例的关键路径上; 0号进程加载GPU reader, 其余为CPU
+    get_ocr_reader(use_gpu=True)
+
+
+def _process_case_worker(idx, oct_type, output_base_dir_str, year):
     """
-    工作者进程入口, 接收纯dict数据并调用process_single_case
+    工作者进程入口, 按行号取出病例dict并调用process_single_case
     """
-    row_data = dict(row_dict)
     output_dir = Path(output_base_dir_str)
-    result = process_single_case(row_data, oct_type, output_dir, year)
+    result = process_single_case(_worker_case_rows[idx], oct_type, output_dir, year)
     return idx, result
 
 
-def process_excel_sheet(excel_path, sheet_name, output_base_dir):
+def open_excel_file(excel_path):
+    """
+    打开Excel工作簿: 安装了python-calamine时使用calamine引擎, 否则(或pandas<2.2不支持该引擎时)使用openpyxl
+    """
+    if EXCEL_ENGINE == 'calamine':
+        try:
+            return pd.ExcelFile(excel_path, engine='calamine')
+        except ValueError:
+            pass
+    return pd.ExcelFile(excel_path, engine='openpyxl')
+
+
+def process_excel_sheet(excel_path, sheet_name, output_base_dir, excel_file=None):
     """
     处理葡萄膜炎Excel中的单个 sheet (科林 / 视微)
+    excel_file: 已打开的pd.ExcelFile(可选), 处理多个sheet时共用, 工作簿只解析一次
     """
     excel_path = Path(excel_path)
     year_match = re.search(r'(\d{4})', excel_path.name)
@@ -773,7 +806,11 @@ def process_excel_sheet(excel_path, sheet_name, output_base_dir):
     print(f"{'='*70}\n")
 
     try:
-        df = pd.read_excel(excel_path, sheet_name=sheet_name, engine='openpyxl')
+        if excel_file is not None:
+            df = excel_file.parse(sheet_name)
+        else:
+            with open_excel_file(excel_path) as excel_file:
+                df = excel_file.parse(sheet_name)
     except Exception as e:
         print(f"错误: 无法读取sheet '{sheet_name}' - {e}")
         return []
@@ -803,25 +840,46 @@ def process_excel_sheet(excel_path, sheet_name, output_base_dir):
                 print(f"    - {error}")
         print()
 
-    rows_payload = [(idx, df.iloc[idx].to_dict()) for idx in range(total_cases)]
+    # 一次性转换为纯dict记录列表, 避免逐行iloc构造Series; 子进程收到的也是体积更小的dict
+    # 转换后即释放DataFrame, 创建进程池前父进程只保留一份行数据
+    rows = df.to_dict(orient='records')
+    del df
+
+    # 先并行预读月份目录(各病例查找患者文件夹都要扫描这些目录), 再创建进程池
+    prefetch_month_listings(rows)
 
     if worker_count == 1:
-        for idx, row_dict in rows_payload:
+        for idx, row_dict in enumerate(rows):
             result = process_single_case(row_dict, sheet_name, output_base_dir, year)
             results[idx] = result
             log_case_result(idx, result)
     else:
-        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+        # 0号进程独占GPU做OCR, 其余进程使用CPU OCR, 按进程数平分CPU核心给PyTorch
+        torch_threads = max(1, CPU_COUNT // worker_count)
+        # 显式使用fork启动子进程: 行数据随initargs经fork继承(写时复制), 不做序列化;
+        # 不支持fork的平台, 或父进程已初始化CUDA(此前单病例sheet在父进程中用GPU做过OCR,
+        # fork出的子进程无法再使用CUDA)时, 改用spawn启动
+        torch_module = sys.modules.get('torch')
+        cuda_initialized = torch_module is not None and torch_module.cuda.is_initialized()
+        if cuda_initialized:
+            mp_context = multiprocessing.get_context('spawn')
+        elif 'fork' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('fork')
+        else:
+            mp_context = None
+        worker_counter = (mp_context or multiprocessing).Value('i', 0)
+        with ProcessPoolExecutor(max_workers=worker_count, mp_context=mp_context,
+                                 initializer=init_case_worker,
+                                 initargs=(rows, worker_counter, torch_threads)) as executor:
             future_to_idx = {
                 executor.submit(
                     _process_case_worker,
                     idx,
-                    row_dict,
                     sheet_name,
                     str(output_base_dir),
                     year
                 ): idx
-                for idx, row_dict in rows_payload
+                for idx in range(total_cases)
             }
 
             for future in as_completed(future_to_idx):
@@ -852,9 +910,11 @@ def main():
         return
 
     all_results = []
-    for sheet in sheets:
-        results = process_excel_sheet(input_excel, sheet, output_base_dir)
-        all_results.extend(results)
+    # 工作簿只打开一次, 各sheet共用
+    with open_excel_file(input_excel) as excel_file:
+        for sheet in sheets:
+            results = process_excel_sheet(input_excel, sheet, output_base_dir, excel_file=excel_file)
+            all_results.extend(results)
 
     print("\n" + "="*70)
     print("处理完成 - 汇总统计")
@@ -883,38 +943,42 @@ def main():
     output_base_dir.mkdir(parents=True, exist_ok=True)
     report_path = output_base_dir / "提取报告_葡萄膜炎.txt"
 
+    # 报告内容先在内存中拼接, 最后一次写出
+    parts = []
+    parts.append("="*70 + "\n")
+    parts.append("葡萄膜炎 - 图像提取报告\n")
+    parts.append("="*70 + "\n\n")
+    parts.append(f"处理时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+    parts.append(f"Excel文件: {input_excel}\n")
+    parts.append(f"输出目录: {output_base_dir}\n\n")
+
+    parts.append(f"总病例数: {total_cases}\n")
+    parts.append(f"找到OCT: {oct_found} ({(oct_found/total_cases*100 if total_cases else 0):.1f}%)\n")
+    parts.append(f"找到FFA: {ffa_found} ({(ffa_found/total_cases*100 if total_cases else 0):.1f}%)\n")
+    parts.append(f"提取OCT图像: {total_oct_images} 张\n")
+    parts.append(f"提取FFA图像: {total_ffa_images} 张\n")
+    parts.append(f"有问题的病例: {cases_with_errors}\n\n")
+
+    parts.append("="*70 + "\n")
+    parts.append("详细病例列表\n")
+    parts.append("="*70 + "\n\n")
+
+    for i, r in enumerate(all_results, 1):
+        parts.append(f"{i}. {r['patient_name']} - {r['visit_date']} ({r['eye_type']})\n")
+        parts.append(f"   OCT: {'✓' if r['oct_found'] else '✗'} ({r['oct_extracted']}张)\n")
+        parts.append(f"   FFA: {'✓' if r['ffa_found'] else '✗'} ({r['ffa_extracted']}张)\n")
+        if r['errors']:
+            parts.append("   问题:\n")
+            for e in r['errors']:
+                parts.append(f"     - {e}\n")
+        if r['oct_path']:
+            parts.append(f"   OCT路径: {r['oct_path']}\n")
+        if r['ffa_path']:
+            parts.append(f"   FFA路径: {r['ffa_path']}\n")
+        parts.append("\n")
+
     with open(report_path, 'w', encoding='utf-8') as f:
-        f.write("="*70 + "\n")
-        f.write("葡萄膜炎 - 图像提取报告\n")
-        f.write("="*70 + "\n\n")
-        f.write(f"处理时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"Excel文件: {input_excel}\n")
-        f.write(f"输出目录: {output_base_dir}\n\n")
-
-        f.write(f"总病例数: {total_cases}\n")
-        f.write(f"找到OCT: {oct_found} ({(oct_found/total_cases*100 if total_cases else 0):.1f}%)\n")
-        f.write(f"找到FFA: {ffa_found} ({(ffa_found/total_cases*100 if total_cases else 0):.1f}%)\n")
-        f.write(f"提取OCT图像: {total_oct_images} 张\n")
-        f.write(f"提取FFA图像: {total_ffa_images} 张\n")
-        f.write(f"有问题的病例: {cases_with_errors}\n\n")
-
-        f.write("="*70 + "\n")
-        f.write("详细病例列表\n")
-        f.write("="*70 + "\n\n")
-
-        for i, r in enumerate(all_results, 1):
-            f.write(f"{i}. {r['patient_name']} - {r['visit_date']} ({r['eye_type']})\n")
-            f.write(f"   OCT: {'✓' if r['oct_found'] else '✗'} ({r['oct_extracted']}张)\n")
-            f.write(f"   FFA: {'✓' if r['ffa_found'] else '✗'} ({r['ffa_extracted']}张)\n")
-            if r['errors']:
-                f.write("   问题:\n")
-                for e in r['errors']:
-                    f.write(f"     - {e}\n")
-            if r['oct_path']:
-                f.write(f"   OCT路径: {r['oct_path']}\n")
-            if r['ffa_path']:
-                f.write(f"   FFA路径: {r['ffa_path']}\n")
-            f.write("\n")
+        f.write("".join(parts))
 
     print(f"\n详细报告已保存: {report_path}")
     print("="*70)
@@ -6,15 +6,24 @@ Export presence matrix into an Excel file (单眼/双眼 分开统计).
 from __future__ import annotations
 
 import argparse
+import functools
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional, Tuple
 
 import pandas as pd
+import xlsxwriter
 
 DEFAULT_ROOT = "/share/kongzitai/ophthalmology/E:"
 MATRIX_OUT_DIR = "/data2/xuhanyang/眼科大模型"
 
+# 读取检查报告txt的线程数（纯I/O，读文件时释放GIL）
+TXT_READ_THREADS = 32
+# 按患者并发扫描目录的线程数
+SCAN_THREADS = 16
+
 # 要处理的疾病列表
 DISEASES = [
     "2023-中心性浆液性脉络膜视网膜病变",
@@ -31,17 +40,23 @@ def is_b_scan(name: str) -> bool:
 
 
 def read_text_file_with_best_effort(file_path: str) -> str:
-    for enc in ("utf-8", "gb18030", "gbk", "ansi"):
-        try:
-            with open(file_path, "r", encoding=enc, errors="ignore") as f:
-                return f.read().strip()
-        except Exception:
-            continue
+    # 只打开读取一次，在内存中解码：报告基本是UTF-8或GB18030（GBK的超集），
+    # 先严格按UTF-8解码，失败再按GB18030忽略错误解码
     try:
         with open(file_path, "rb") as f:
-            return f.read().decode("utf-8", errors="ignore").strip()
+            data = f.read()
     except Exception:
         return ""
+    try:
+        return data.decode("utf-8").strip()
+    except UnicodeDecodeError:
+        return data.decode("gb18030", errors="ignore").strip()
+
+
+def list_subdir_names(dir_path: str) -> List[str]:
+    """列出子目录名；scandir的目录项自带文件类型，不必再对每个子项调用isdir()"""
+    with os.scandir(dir_path) as it:
+        return [entry.name for entry in it if entry.is_dir()]
 
 
 def normalize_for_match(s: str) -> str:
@@ -49,6 +64,36 @@ def normalize_for_match(s: str) -> str:
 
 
 # ---------- 分类函数 ----------
+# classify_exam用到的关键词在模块加载时预先归一化/编译，避免每次调用重复计算
+FFA_KEYWORD_RE = re.compile("ffa|荧光造影|icg|吲哚青")
+OCT_SUB_PATTERNS = [
+    (normalize_for_match(sub), sub)
+    for sub in (
+        "海德堡OCT 血流模式",
+        "海德堡OCT",
+        "视微OCT 血流模式",
+        "视微OCT",
+        "科林OCT 血流模式",
+        "科林OCT",
+        "图湃OCT 血流模式",
+        "图湃OCT",
+        "蔡司OCT",
+    )
+]
+ZEISS_NORMS = tuple(
+    normalize_for_match(v)
+    for v in ("激光广角眼底照相（蔡司真彩）", "激光广角眼底照相(蔡司真彩)", "蔡司真彩")
+)
+OPTOS_NORMS = tuple(
+    normalize_for_match(v)
+    for v in ("激光广角眼底照相检查(欧堡)", "激光广角眼底照相检查（欧堡）",
+              "激光广角眼底照相检查(欧宝)", "激光广角眼底照相检查（欧宝）", "optos")
+)
+FUNDUS_NORMS = tuple(normalize_for_match(v) for v in ("眼底照相", "眼底彩照", "fundusphoto"))
+
+
+# 检查文件夹名在不同患者/就诊间大量重复，分类结果按名称缓存
+@functools.lru_cache(maxsize=65536)
 def classify_exam(exam_name: str) -> tuple[str, str, str]:
     """
     返回 (major, sub, eye_type)
@@ -70,42 +115,26 @@ def classify_exam(exam_name: str) -> tuple[str, str, str]:
         return "B超", "B超", eye_type
 
     # 3. 造影
-    if any(k in lower for k in ("ffa", "荧光造影", "眼底荧光造影", "icg", "吲哚青")):
+    if FFA_KEYWORD_RE.search(lower):
         return "造影", "眼底荧光造影", eye_type
 
     # 4. OCT 子类
-    oct_sub = [
-        "海德堡OCT 血流模式",
-        "海德堡OCT",
-        "视微OCT 血流模式",
-        "视微OCT",
-        "科林OCT 血流模式",
-        "科林OCT",
-        "图湃OCT 血流模式",
-        "图湃OCT",
-        "蔡司OCT",
-    ]
-    for sub in oct_sub:
-        if normalize_for_match(sub) in norm:
+    for sub_norm, sub in OCT_SUB_PATTERNS:
+        if sub_norm in norm:
             return "OCT", sub, eye_type
     if "oct" in lower:
         return "OCT", "OCT", eye_type
 
     # 5. 眼底拍照
-    zeiss_var = ["激光广角眼底照相（蔡司真彩）", "激光广角眼底照相(蔡司真彩)", "蔡司真彩"]
-    for v in zeiss_var:
-        if normalize_for_match(v) in norm:
-            return "眼底拍照", "激光广角眼底照相（蔡司真彩）", eye_type
+    if any(v in norm for v in ZEISS_NORMS):
+        return "眼底拍照", "激光广角眼底照相（蔡司真彩）", eye_type
     # 欧堡检查：同时支持"欧堡"和"欧宝"（早期错别字）
     if "欧堡" in name or "欧宝" in name:
         return "眼底拍照", "激光广角眼底照相检查(欧堡)", eye_type
-    for v in ["激光广角眼底照相检查(欧堡)", "激光广角眼底照相检查（欧堡）",
-              "激光广角眼底照相检查(欧宝)", "激光广角眼底照相检查（欧宝）", "optos"]:
-        if normalize_for_match(v) in norm:
-            return "眼底拍照", "激光广角眼底照相检查(欧堡)", eye_type
-    for v in ["眼底照相", "眼底彩照", "fundusphoto"]:
-        if normalize_for_match(v) in norm:
-            return "眼底拍照", "眼底照相", eye_type
+    if any(v in norm for v in OPTOS_NORMS):
+        return "眼底拍照", "激光广角眼底照相检查(欧堡)", eye_type
+    if any(v in norm for v in FUNDUS_NORMS):
+        return "眼底拍照", "眼底照相", eye_type
 
     return "其他", "", eye_type
 
@@ -136,36 +165,28 @@ def parse_patient_name_from_folder(folder_basename: str) -> str:
 
 
 # ---------- 扫描目录 ----------
-def collect_exam_records(root_dir: str) -> List[ExamRecord]:
-    records: List[ExamRecord] = []
-    if not os.path.isdir(root_dir):
-        return records
+def scan_patient_folder(root_dir: str, pf: str) -> List[Tuple[ExamRecord, List[str]]]:
+    """
+    扫描一个患者文件夹下的所有就诊/检查目录
+    返回: [(记录, 待读取的txt路径), ...]，txt内容由调用方统一读取
 
-    for pf in sorted(os.listdir(root_dir)):
-        pf_path = os.path.join(root_dir, pf)
-        if not os.path.isdir(pf_path):
-            continue
-        try:
-            visits = [v for v in os.listdir(pf_path) if os.path.isdir(os.path.join(pf_path, v))]
-        except Exception:
-            continue
-        for vd in sorted(visits):
-            vd_path = os.path.join(pf_path, vd)
-            try:
-                exams = [e for e in os.listdir(vd_path) if os.path.isdir(os.path.join(vd_path, e))]
-            except Exception:
-                continue
-            for ex in sorted(exams):
-                ex_path = os.path.join(vd_path, ex)
-                try:
-                    txts = [f for f in os.listdir(ex_path) if f.lower().endswith(".txt")]
-                except Exception:
-                    txts = []
+    用一次os.walk遍历患者子树，按相对深度区分层级：深度1为就诊日期目录（dirs即检查目录），
+    深度2为检查目录（files即其中的文件，不再单独listdir）
+    """
+    jobs: List[Tuple[ExamRecord, List[str]]] = []
+    exam_jobs = {}  # 检查目录路径 -> (记录, txt路径列表)
+    pf_path = os.path.join(root_dir, pf)
+    pf_depth = pf_path.count(os.sep)
+    for root, dirs, files in os.walk(pf_path, followlinks=True):
+        depth = root.count(os.sep) - pf_depth
+        dirs.sort()
+        if depth == 1:
+            vd = os.path.basename(root)
+            for ex in dirs:
+                ex_path = os.path.join(root, ex)
                 major, sub, eye = classify_exam(ex)
-                txts_sorted = sorted(txts)
-                txt_cont = [read_text_file_with_best_effort(os.path.join(ex_path, f)) for f in txts_sorted]
-                padded = (txt_cont + [""] * 4)[:4]
-                records.append(
+                # 检查目录无法读取时保留记录，txt为空
+                job = (
                     ExamRecord(
                         diagnosis="",
                         detect_dir=ex_path,
@@ -176,14 +197,52 @@ def collect_exam_records(root_dir: str) -> List[ExamRecord]:
                         major_category=major,
                         sub_category=sub,
                         eye_type=eye,
-                        txt_count=len(txts_sorted),
-                        txt_filenames=";".join(txts_sorted),
-                        txt_1=padded[0],
-                        txt_2=padded[1],
-                        txt_3=padded[2],
-                        txt_4=padded[3],
-                    )
+                        txt_count=0,
+                        txt_filenames="",
+                        txt_1="",
+                        txt_2="",
+                        txt_3="",
+                        txt_4="",
+                    ),
+                    [],
                 )
+                jobs.append(job)
+                exam_jobs[ex_path] = job
+        elif depth == 2:
+            dirs[:] = []  # 检查目录以下不再深入
+            record, txt_paths = exam_jobs[root]
+            txts_sorted = sorted(f for f in files if f.lower().endswith(".txt"))
+            record.txt_count = len(txts_sorted)
+            record.txt_filenames = ";".join(txts_sorted)
+            # 只有前4个txt的内容会写入记录
+            txt_paths.extend(os.path.join(root, f) for f in txts_sorted[:4])
+    return jobs
+
+
+def collect_exam_records(root_dir: str) -> List[ExamRecord]:
+    records: List[ExamRecord] = []
+    if not os.path.isdir(root_dir):
+        return records
+
+    try:
+        patient_folders = sorted(list_subdir_names(root_dir))
+    except Exception:
+        return records
+
+    # 各患者子树互不相关，按患者分发到线程池并发扫描（网络盘上目录读取主要是等待延迟），
+    # map保持患者顺序；扫描完成后再统一并发读取txt
+    txt_jobs: List[Tuple[ExamRecord, List[str]]] = []
+    with ThreadPoolExecutor(max_workers=SCAN_THREADS) as executor:
+        for patient_jobs in executor.map(lambda pf: scan_patient_folder(root_dir, pf), patient_folders):
+            txt_jobs.extend(patient_jobs)
+    records = [record for record, _ in txt_jobs]
+
+    all_paths = [path for _, paths in txt_jobs for path in paths]
+    with ThreadPoolExecutor(max_workers=TXT_READ_THREADS) as executor:
+        contents = iter(list(executor.map(read_text_file_with_best_effort, all_paths)))
+    for record, paths in txt_jobs:
+        padded = ([next(contents) for _ in paths] + [""] * 4)[:4]
+        record.txt_1, record.txt_2, record.txt_3, record.txt_4 = padded
     return records
 
 
@@ -208,8 +267,6 @@ FUNDUS_SUBTYPES = [
 
 
 def build_presence_matrix(records: List[ExamRecord]) -> pd.DataFrame:
-    index_keys = sorted({(r.patient_folder, r.patient_i_name, r.visit_date) for r in records})
-
     def make_col(base: str) -> List[str]:
         return [f"{base}(单眼)", f"{base}(双眼)"]
 
@@ -223,31 +280,35 @@ def build_presence_matrix(records: List[ExamRecord]) -> pd.DataFrame:
         + [f"{fund}(双眼)" for fund in FUNDUS_SUBTYPES]
     )
 
-    rows = []
-    zero = {c: 0 for c in columns}
-    for pf, pn, vd in index_keys:
-        row = zero.copy()
-        row.update({"patient_folder": pf, "patient_i_name": pn, "visit_date": vd})
-        rows.append(row)
-    key_to_row = {(r["patient_folder"], r["patient_i_name"], r["visit_date"]): r for r in rows}
-
-    for r in records:
-        key = (r.patient_folder, r.patient_i_name, r.visit_date)
-        row = key_to_row.get(key)
-        if row is None:
-            continue
+    def presence_column(r: ExamRecord) -> Optional[str]:
         eye = r.eye_type or "双眼"  # 未标注默认算双眼
-        if r.major_category == "B超":
-            row[f"B超({eye})"] = 1
-        elif r.major_category == "造影":
-            row[f"造影({eye})"] = 1
-        elif r.major_category == "OCT" and r.sub_category in OCT_SUBTYPES:
-            row[f"{r.sub_category}({eye})"] = 1
-        elif r.major_category == "眼底拍照" and r.sub_category in FUNDUS_SUBTYPES:
-            row[f"{r.sub_category}({eye})"] = 1
+        if r.major_category in ("B超", "造影"):
+            return f"{r.major_category}({eye})"
+        if r.major_category == "OCT" and r.sub_category in OCT_SUBTYPES:
+            return f"{r.sub_category}({eye})"
+        if r.major_category == "眼底拍照" and r.sub_category in FUNDUS_SUBTYPES:
+            return f"{r.sub_category}({eye})"
+        return None
+
+    # 每条记录一行 (就诊键, 对应列)，由get_dummies + groupby.max一次生成0/1矩阵；
+    # 不属于任何列的记录在get_dummies中为全0行，仍保留其就诊键
+    key_cols = columns[:3]
+    flag_cols = columns[3:]
+    hits = pd.DataFrame(
+        [(r.patient_folder, r.patient_i_name, r.visit_date, presence_column(r)) for r in records],
+        columns=key_cols + ["col"],
+    )
+    presence = (
+        pd.get_dummies(hits["col"])
+        .reindex(columns=flag_cols, fill_value=0)
+        .groupby([hits[c] for c in key_cols])
+        .max()
+        .astype(int)
+        .reset_index()
+    )
 
     return (
-        pd.DataFrame(rows, columns=columns)
+        presence[columns]
         .sort_values(["patient_folder", "visit_date"])
         .reset_index(drop=True)
     )
@@ -256,8 +317,17 @@ def build_presence_matrix(records: List[ExamRecord]) -> pd.DataFrame:
 # ---------- 导出 ----------
 def export_to_excel(df: pd.DataFrame, out_path: str) -> None:
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with pd.ExcelWriter(out_path, engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False)
+    # constant_memory模式下xlsxwriter每写完一行就刷到临时文件，内存中只保留当前行；
+    # 该模式要求严格按行顺序写入，而DataFrame.to_excel是逐列写单元格的，因此这里直接逐行写出
+    workbook = xlsxwriter.Workbook(out_path, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet("Sheet1")
+        header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+        worksheet.write_row(0, 0, list(df.columns), header_format)
+        for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_idx, 0, row)
+    finally:
+        workbook.close()
 
 
 # ---------- CLI ----------
@@ -6,9 +6,13 @@ Export presence matrix by year (按年份统计，合并月份数据，去重).
 from __future__ import annotations
 
 import argparse
+import functools
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import List, Set, Tuple
+from itertools import repeat
+from typing import List, Optional, Set, Tuple
 from pathlib import Path
 
 import pandas as pd
@@ -16,6 +20,9 @@ import pandas as pd
 DEFAULT_ROOT = "/share/kongzitai/ophthalmology/E:"
 MATRIX_OUT_DIR = "/data2/xuhanyang/眼科大模型/年度数据"
 
+# 按患者并发扫描目录的进程数
+SCAN_WORKERS = os.cpu_count() or 1
+
 # 要处理的年份
 YEARS = ["2019", "2020", "2021", "2022", "2023", "2024", "2025"]
 
@@ -27,17 +34,23 @@ def is_b_scan(name: str) -> bool:
 
 
 def read_text_file_with_best_effort(file_path: str) -> str:
-    for enc in ("utf-8", "gb18030", "gbk", "ansi"):
-        try:
-            with open(file_path, "r", encoding=enc, errors="ignore") as f:
-                return f.read().strip()
-        except Exception:
-            continue
+    # 只打开读取一次，在内存中解码：报告基本是UTF-8或GB18030（GBK的超集），
+    # 先严格按UTF-8解码，失败再按GB18030忽略错误解码
     try:
         with open(file_path, "rb") as f:
-            return f.read().decode("utf-8", errors="ignore").strip()
+            data = f.read()
     except Exception:
         return ""
+    try:
+        return data.decode("utf-8").strip()
+    except UnicodeDecodeError:
+        return data.decode("gb18030", errors="ignore").strip()
+
+
+def list_subdir_names(dir_path: str) -> List[str]:
+    """列出子目录名；scandir的目录项自带文件类型，不必再对每个子项调用isdir()"""
+    with os.scandir(dir_path) as it:
+        return [entry.name for entry in it if entry.is_dir()]
 
 
 def normalize_for_match(s: str) -> str:
@@ -45,6 +58,36 @@ def normalize_for_match(s: str) -> str:
 
 
 # ---------- 分类函数 ----------
+# classify_exam用到的关键词在模块加载时预先归一化/编译，避免每次调用重复计算
+FFA_KEYWORD_RE = re.compile("ffa|荧光造影|icg|吲哚青")
+OCT_SUB_PATTERNS = [
+    (normalize_for_match(sub), sub)
+    for sub in (
+        "海德堡OCT 血流模式",
+        "海德堡OCT",
+        "视微OCT 血流模式",
+        "视微OCT",
+        "科林OCT 血流模式",
+        "科林OCT",
+        "图湃OCT 血流模式",
+        "图湃OCT",
+        "蔡司OCT",
+    )
+]
+ZEISS_NORMS = tuple(
+    normalize_for_match(v)
+    for v in ("激光广角眼底照相（蔡司真彩）", "激光广角眼底照相(蔡司真彩)", "蔡司真彩")
+)
+OPTOS_NORMS = tuple(
+    normalize_for_match(v)
+    for v in ("激光广角眼底照相检查(欧堡)", "激光广角眼底照相检查（欧堡）",
+              "激光广角眼底照相检查(欧宝)", "激光广角眼底照相检查（欧宝）", "optos")
+)
+FUNDUS_NORMS = tuple(normalize_for_match(v) for v in ("眼底照相", "眼底彩照", "fundusphoto"))
+
+
+# 检查文件夹名在不同患者/就诊间大量重复，分类结果按名称缓存
+@functools.lru_cache(maxsize=65536)
 def classify_exam(exam_name: str) -> tuple[str, str, str]:
     """
     返回 (major, sub, eye_type)
@@ -66,42 +109,26 @@ def classify_exam(exam_name: str) -> tuple[str, str, str]:
         return "B超", "B超", eye_type
 
     # 3. 造影
-    if any(k in lower for k in ("ffa", "荧光造影", "眼底荧光造影", "icg", "吲哚青")):
+    if FFA_KEYWORD_RE.search(lower):
         return "造影", "眼底荧光造影", eye_type
 
     # 4. OCT 子类
-    oct_sub = [
-        "海德堡OCT 血流模式",
-        "海德堡OCT",
-        "视微OCT 血流模式",
-        "视微OCT",
-        "科林OCT 血流模式",
-        "科林OCT",
-        "图湃OCT 血流模式",
-        "图湃OCT",
-        "蔡司OCT",
-    ]
-    for sub in oct_sub:
-        if normalize_for_match(sub) in norm:
+    for sub_norm, sub in OCT_SUB_PATTERNS:
+        if sub_norm in norm:
             return "OCT", sub, eye_type
     if "oct" in lower:
         return "OCT", "OCT", eye_type
 
     # 5. 眼底拍照
-    zeiss_var = ["激光广角眼底照相（蔡司真彩）", "激光广角眼底照相(蔡司真彩)", "蔡司真彩"]
-    for v in zeiss_var:
-        if normalize_for_match(v) in norm:
-            return "眼底拍照", "激光广角眼底照相（蔡司真彩）", eye_type
+    if any(v in norm for v in ZEISS_NORMS):
+        return "眼底拍照", "激光广角眼底照相（蔡司真彩）", eye_type
     # 欧堡检查：同时支持"欧堡"和"欧宝"（早期错别字）
     if "欧堡" in name or "欧宝" in name:
         return "眼底拍照", "激光广角眼底照相检查(欧堡)", eye_type
-    for v in ["激光广角眼底照相检查(欧堡)", "激光广角眼底照相检查（欧堡）", 
-              "激光广角眼底照相检查(欧宝)", "激光广角眼底照相检查（欧宝）", "optos"]:
-        if normalize_for_match(v) in norm:
-            return "眼底拍照", "激光广角眼底照相检查(欧堡)", eye_type
-    for v in ["眼底照相", "眼底彩照", "fundusphoto"]:
-        if normalize_for_match(v) in norm:
-            return "眼底拍照", "眼底照相", eye_type
+    if any(v in norm for v in OPTOS_NORMS):
+        return "眼底拍照", "激光广角眼底照相检查(欧堡)", eye_type
+    if any(v in norm for v in FUNDUS_NORMS):
+        return "眼底拍照", "眼底照相", eye_type
 
     return "其他", "", eye_type
 
@@ -133,10 +160,66 @@ def parse_patient_name_from_folder(folder_basename: str) -> str:
 
 
 # ---------- 扫描目录 ----------
+def scan_patient(month_folder: str, pf_path: str) -> List[ExamRecord]:
+    """
+    扫描单个患者文件夹下的所有就诊/检查目录（不去重，去重由调用方统一完成）
+    """
+    records: List[ExamRecord] = []
+    pf = os.path.basename(pf_path)
+    try:
+        visits = list_subdir_names(pf_path)
+    except Exception:
+        return records
+
+    for vd in visits:
+        vd_path = os.path.join(pf_path, vd)
+        try:
+            exams = list_subdir_names(vd_path)
+        except Exception:
+            continue
+
+        for ex in exams:
+            ex_path = os.path.join(vd_path, ex)
+            try:
+                txts = [f for f in os.listdir(ex_path) if f.lower().endswith(".txt")]
+            except Exception:
+                txts = []
+
+            major, sub, eye = classify_exam(ex)
+            txts_sorted = sorted(txts)
+            txt_cont = [read_text_file_with_best_effort(os.path.join(ex_path, f)) for f in txts_sorted]
+            padded = (txt_cont + [""] * 4)[:4]
+
+            records.append(
+                ExamRecord(
+                    diagnosis="",
+                    detect_dir=ex_path,
+                    patient_folder=pf,
+                    patient_i_name=parse_patient_name_from_folder(pf),
+                    visit_date=vd,
+                    detect_ty=ex,
+                    major_category=major,
+                    sub_category=sub,
+                    eye_type=eye,
+                    txt_count=len(txts_sorted),
+                    txt_filenames=";".join(txts_sorted),
+                    txt_1=padded[0],
+                    txt_2=padded[1],
+                    txt_3=padded[2],
+                    txt_4=padded[3],
+                    month_folder=month_folder,
+                )
+            )
+    return records
+
+
 def collect_exam_records_for_year(year_dir: str) -> Tuple[List[ExamRecord], Set[Tuple]]:
     """
     收集一个年份目录下所有月份文件夹的检查记录
     返回: (记录列表, 去重用的key集合)
+
+    各患者子树互不相关，按患者分发到进程池并发扫描（目录读取、txt解码、分类）；
+    map保持原有顺序，去重在主进程中按原顺序进行，结果与顺序扫描一致
     """
     records: List[ExamRecord] = []
     seen_keys: Set[Tuple] = set()  # 用于去重: (patient_folder, visit_date, detect_ty)
@@ -146,45 +229,33 @@ def collect_exam_records_for_year(year_dir: str) -> Tuple[List[ExamRecord], Set[
 
     # 获取所有月份文件夹
     try:
-        month_folders = sorted([f for f in os.listdir(year_dir) if os.path.isdir(os.path.join(year_dir, f))])
+        month_folders = sorted(list_subdir_names(year_dir))
     except Exception:
         return records, seen_keys
 
     print(f"  找到月份文件夹: {', '.join(month_folders)}")
 
-    for month_folder in month_folders:
-        month_path = os.path.join(year_dir, month_folder)
-        print(f"    处理月份: {month_folder}", end=" ... ")
-        
-        month_records = 0
-        duplicates = 0
-        
-        # 遍历患者文件夹
-        try:
-            patient_folders = [pf for pf in os.listdir(month_path) if os.path.isdir(os.path.join(month_path, pf))]
-        except Exception:
-            print("错误")
-            continue
-
-        for pf in patient_folders:
-            pf_path = os.path.join(month_path, pf)
+    with ProcessPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        for month_folder in month_folders:
+            month_path = os.path.join(year_dir, month_folder)
+            print(f"    处理月份: {month_folder}", end=" ... ")
+            
+            month_records = 0
+            duplicates = 0
+            
+            # 遍历患者文件夹
             try:
-                visits = [v for v in os.listdir(pf_path) if os.path.isdir(os.path.join(pf_path, v))]
+                patient_folders = list_subdir_names(month_path)
             except Exception:
+                print("错误")
                 continue
-            
-            for vd in visits:
-                vd_path = os.path.join(pf_path, vd)
-                try:
-                    exams = [e for e in os.listdir(vd_path) if os.path.isdir(os.path.join(vd_path, e))]
-                except Exception:
-                    continue
-                
-                for ex in exams:
-                    ex_path = os.path.join(vd_path, ex)
-                    
+
+            patient_paths = [os.path.join(month_path, pf) for pf in patient_folders]
+            for patient_records in executor.map(scan_patient, repeat(month_folder), patient_paths,
+                                                chunksize=32):
+                for record in patient_records:
                     # 生成去重key
-                    dedup_key = (pf, vd, ex)
+                    dedup_key = (record.patient_folder, record.visit_date, record.detect_ty)
                     
                     # 检查是否已存在
                     if dedup_key in seen_keys:
@@ -192,40 +263,10 @@ def collect_exam_records_for_year(year_dir: str) -> Tuple[List[ExamRecord], Set[
                         continue
                     
                     seen_keys.add(dedup_key)
-                    
-                    try:
-                        txts = [f for f in os.listdir(ex_path) if f.lower().endswith(".txt")]
-                    except Exception:
-                        txts = []
-                    
-                    major, sub, eye = classify_exam(ex)
-                    txts_sorted = sorted(txts)
-                    txt_cont = [read_text_file_with_best_effort(os.path.join(ex_path, f)) for f in txts_sorted]
-                    padded = (txt_cont + [""] * 4)[:4]
-                    
-                    records.append(
-                        ExamRecord(
-                            diagnosis="",
-                            detect_dir=ex_path,
-                            patient_folder=pf,
-                            patient_i_name=parse_patient_name_from_folder(pf),
-                            visit_date=vd,
-                            detect_ty=ex,
-                            major_category=major,
-                            sub_category=sub,
-                            eye_type=eye,
-                            txt_count=len(txts_sorted),
-                            txt_filenames=";".join(txts_sorted),
-                            txt_1=padded[0],
-                            txt_2=padded[1],
-                            txt_3=padded[2],
-                            txt_4=padded[3],
-                            month_folder=month_folder,
-                        )
-                    )
+                    records.append(record)
                     month_records += 1
-        
-        print(f"新增 {month_records} 条, 去重 {duplicates} 条")
+            
+            print(f"新增 {month_records} 条, 去重 {duplicates} 条")
     
     return records, seen_keys
 
@@ -251,8 +292,6 @@ FUNDUS_SUBTYPES = [
 
 
 def build_presence_matrix(records: List[ExamRecord]) -> pd.DataFrame:
-    index_keys = sorted({(r.patient_folder, r.patient_i_name, r.visit_date) for r in records})
-
     def make_col(base: str) -> List[str]:
         return [f"{base}(单眼)", f"{base}(双眼)"]
 
@@ -267,49 +306,41 @@ def build_presence_matrix(records: List[ExamRecord]) -> pd.DataFrame:
         + [f"{fund}(双眼)" for fund in FUNDUS_SUBTYPES]
     )
 
-    rows = []
-    zero = {c: 0 if c not in ["造影报告"] else "" for c in columns}
-    for pf, pn, vd in index_keys:
-        row = zero.copy()
-        row.update({"patient_folder": pf, "patient_i_name": pn, "visit_date": vd})
-        rows.append(row)
-    key_to_row = {(r["patient_folder"], r["patient_i_name"], r["visit_date"]): r for r in rows}
-
-    # 用于收集同一患者同一就诊日期的所有造影报告
-    ffa_reports = {}  # key: (patient_folder, patient_i_name, visit_date), value: list of reports
-    
-    for r in records:
-        key = (r.patient_folder, r.patient_i_name, r.visit_date)
-        row = key_to_row.get(key)
-        if row is None:
-            continue
+    def presence_column(r: ExamRecord) -> Optional[str]:
         eye = r.eye_type or "双眼"  # 未标注默认算双眼
-        if r.major_category == "B超":
-            row[f"B超({eye})"] = 1
-        elif r.major_category == "造影":
-            row[f"造影({eye})"] = 1
-            # 收集造影报告内容
-            report_texts = []
-            for txt in [r.txt_1, r.txt_2, r.txt_3, r.txt_4]:
-                if txt.strip():
-                    report_texts.append(txt.strip())
-            if report_texts:
-                if key not in ffa_reports:
-                    ffa_reports[key] = []
-                ffa_reports[key].extend(report_texts)
-        elif r.major_category == "OCT" and r.sub_category in OCT_SUBTYPES:
-            row[f"{r.sub_category}({eye})"] = 1
-        elif r.major_category == "眼底拍照" and r.sub_category in FUNDUS_SUBTYPES:
-            row[f"{r.sub_category}({eye})"] = 1
-    
-    # 填充造影报告列（多个txt用空行隔开）
-    for key, reports in ffa_reports.items():
-        row = key_to_row.get(key)
-        if row is not None:
-            row["造影报告"] = "\n\n".join(reports)  # 用双换行符隔开不同的txt
+        if r.major_category in ("B超", "造影"):
+            return f"{r.major_category}({eye})"
+        if r.major_category == "OCT" and r.sub_category in OCT_SUBTYPES:
+            return f"{r.sub_category}({eye})"
+        if r.major_category == "眼底拍照" and r.sub_category in FUNDUS_SUBTYPES:
+            return f"{r.sub_category}({eye})"
+        return None
+
+    def ffa_report(r: ExamRecord) -> str:
+        if r.major_category != "造影":
+            return ""
+        return "\n\n".join(t.strip() for t in (r.txt_1, r.txt_2, r.txt_3, r.txt_4) if t.strip())
+
+    # 每条记录一行 (就诊键, 对应列, 造影报告)，由get_dummies + groupby.max一次生成0/1矩阵；
+    # 不属于任何列的记录在get_dummies中为全0行，仍保留其就诊键
+    key_cols = columns[:3]
+    flag_cols = [c for c in columns[3:] if c != "造影报告"]
+    hits = pd.DataFrame(
+        [(r.patient_folder, r.patient_i_name, r.visit_date, presence_column(r), ffa_report(r)) for r in records],
+        columns=key_cols + ["col", "report"],
+    )
+    presence = (
+        pd.get_dummies(hits["col"])
+        .reindex(columns=flag_cols, fill_value=0)
+        .groupby([hits[c] for c in key_cols])
+        .max()
+        .astype(int)
+    )
+    # 同一就诊的所有造影报告按记录顺序合并（多个txt用空行隔开）
+    presence["造影报告"] = hits.groupby(key_cols)["report"].agg(lambda s: "\n\n".join(t for t in s if t))
 
     return (
-        pd.DataFrame(rows, columns=columns)
+        presence.reset_index()[columns]
         .sort_values(["patient_folder", "visit_date"])
         .reset_index(drop=True)
     )
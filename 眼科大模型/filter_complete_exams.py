@@ -6,16 +6,24 @@
 """
 
 import os
+import re
 from pathlib import Path
 import pandas as pd
 from datetime import datetime, timedelta
 from typing import Dict, List, Set, Tuple
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 DEFAULT_ROOT = "/share/kongzitai/ophthalmology/E:"
 OUTPUT_DIR = "/data2/xuhanyang/眼科大模型/三模态齐全病例"
 YEARS = ["2019", "2020", "2021", "2022", "2023", "2024", "2025"]
 
+# 按患者并发扫描目录的进程数
+SCAN_WORKERS = os.cpu_count() or 1
+
+# 欧堡检查关键词（"欧宝"为早期错别字），模块加载时编译一次
+OPTOS_NAME_RE = re.compile(r'欧堡|欧宝')
+
 
 def get_exam_dates_for_patient(patient_path: Path) -> Dict[str, List]:
     """
@@ -25,17 +33,13 @@ def get_exam_dates_for_patient(patient_path: Path) -> Dict[str, List]:
     """
     exam_dates = defaultdict(list)
     
-    if not patient_path.exists():
-        return exam_dates
-    
     try:
-        # 遍历日期文件夹
-        for date_folder in patient_path.iterdir():
-            if not date_folder.is_dir():
-                continue
-            
+        # 遍历日期文件夹（scandir的目录项自带文件类型，不必对每个子项再stat；患者目录不存在时直接抛出OSError）
+        with os.scandir(patient_path) as date_it:
+            date_entries = [entry for entry in date_it if entry.is_dir()]
+        for date_entry in date_entries:
             # 解析日期
-            date_str = date_folder.name
+            date_str = date_entry.name
             try:
                 exam_date = datetime.strptime(date_str, '%Y-%m-%d')
             except ValueError:
@@ -43,21 +47,21 @@ def get_exam_dates_for_patient(patient_path: Path) -> Dict[str, List]:
             
             # 检查该日期下的检查项目
             try:
-                for exam_folder in date_folder.iterdir():
-                    if not exam_folder.is_dir():
-                        continue
-                    
-                    exam_name = exam_folder.name
+                with os.scandir(date_entry.path) as exam_it:
+                    exam_entries = [entry for entry in exam_it if entry.is_dir()]
+                for exam_entry in exam_entries:
+                    exam_name = exam_entry.name
                     exam_name_lower = exam_name.lower()
+                    has_optos_name = OPTOS_NAME_RE.search(exam_name) is not None
                     
                     # 判断检查类型
                     # 欧堡检查：支持"欧堡"、"欧宝"、"optos"，但排除"海德堡OCT"
                     is_optos = False
                     if 'optos' in exam_name_lower:
                         is_optos = True
-                    elif ('欧堡' in exam_name or '欧宝' in exam_name) and 'oct' not in exam_name_lower:
+                    elif has_optos_name and 'oct' not in exam_name_lower:
                         is_optos = True
-                    elif '广角眼底照相' in exam_name and ('欧堡' in exam_name or '欧宝' in exam_name):
+                    elif '广角眼底照相' in exam_name and has_optos_name:
                         is_optos = True
                     
                     if is_optos:
@@ -68,11 +72,13 @@ def get_exam_dates_for_patient(patient_path: Path) -> Dict[str, List]:
                         # 读取FFA报告
                         ffa_report = ""
                         try:
-                            txt_files = list(exam_folder.glob("*.txt"))
+                            with os.scandir(exam_entry.path) as txt_it:
+                                txt_paths = [entry.path for entry in txt_it
+                                             if entry.name.endswith('.txt') and not entry.name.startswith('.')]
                             report_texts = []
-                            for txt_file in txt_files:
+                            for txt_path in txt_paths:
                                 try:
-                                    with open(txt_file, 'r', encoding='utf-8') as f:
+                                    with open(txt_path, 'r', encoding='utf-8') as f:
                                         content = f.read().strip()
                                         if content:
                                             report_texts.append(content)
@@ -232,6 +238,9 @@ def scan_year_directory(year_path: Path) -> List[Dict]:
     
     total_patient_folders = 0
     
+    # 先列出所有(月份, 患者文件夹)，再把各患者子树分发到进程池并发扫描；
+    # map保持原有顺序，结果在主进程中按原顺序合并
+    patient_jobs = []  # [(month_folder, patient_folder, patient_id, patient_name), ...]
     for month_folder in month_folders:
         try:
             patient_folders = [f for f in month_folder.iterdir() if f.is_dir()]
@@ -242,17 +251,19 @@ def scan_year_directory(year_path: Path) -> List[Dict]:
             total_patient_folders += 1
             
             # 解析患者信息
-            patient_folder_name = patient_folder.name
-            parts = patient_folder_name.split()
+            parts = patient_folder.name.split()
             
             if len(parts) < 4:
                 continue
             
-            patient_id = parts[0]
-            patient_name = parts[1]
-            
-            # 获取该患者在这个文件夹中的所有检查日期
-            exam_dates = get_exam_dates_for_patient(patient_folder)
+            patient_jobs.append((month_folder, patient_folder, parts[0], parts[1]))
+    
+    with ProcessPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        # 获取每个患者在其所在文件夹中的所有检查日期
+        exam_dates_iter = executor.map(get_exam_dates_for_patient,
+                                       [job[1] for job in patient_jobs], chunksize=32)
+        for (month_folder, patient_folder, patient_id, patient_name), exam_dates in zip(patient_jobs, exam_dates_iter):
+            patient_folder_name = patient_folder.name
             
             # 合并到患者的总数据中
             for exam_type, dates in exam_dates.items():
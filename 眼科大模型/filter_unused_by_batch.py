@@ -11,6 +11,10 @@ from pathlib import Path
 from datetime import datetime
 import re
 
+# 报告“按批次统计”部分的批次标题行和文件列表行
+BATCH_HEADER_RE = re.compile(r'^(\d+-\d+-\d+)\s*\((\d+)个文件\):')
+LIST_ITEM_RE = re.compile(r'^\d+\.\s+(.+)$')
+
 def extract_patient_name_from_filename(filename):
     """
     从文件名中提取患者姓名
@@ -162,10 +166,7 @@ def parse_report_file(report_path):
     in_unused_section = False
     in_batch_list = False
     
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        
+    for line in lines:
         # 检测各部分
         if '一、同一日期重复的患者' in line:
             current_section = 'section1'
@@ -196,17 +197,20 @@ def parse_report_file(report_path):
             elif '按批次统计:' in line:
                 in_batch_list = True
             elif in_batch_list:
-                # 检测批次名称
-                batch_match = re.match(r'^(\d+-\d+-\d+)\s*\((\d+)个文件\):', line.strip())
-                if batch_match:
-                    current_batch = batch_match.group(1)
-                    result['unused_images'][current_batch] = []
-                # 检测文件列表项
-                elif current_batch and re.match(r'^\s*\d+\.\s+(.+)$', line.strip()):
-                    file_match = re.match(r'^\s*\d+\.\s+(.+)$', line.strip())
-                    if file_match:
-                        filename = file_match.group(1).strip()
-                        result['unused_images'][current_batch].append(filename)
+                stripped = line.strip()
+                # 批次名称和文件列表项都以数字开头，其他行（空行、分隔线）无需跑正则
+                if stripped[:1].isdigit():
+                    # 检测批次名称
+                    batch_match = BATCH_HEADER_RE.match(stripped) if stripped.endswith('个文件):') else None
+                    if batch_match:
+                        current_batch = batch_match.group(1)
+                        result['unused_images'][current_batch] = []
+                    # 检测文件列表项
+                    elif current_batch:
+                        file_match = LIST_ITEM_RE.match(stripped)
+                        if file_match:
+                            filename = file_match.group(1).strip()
+                            result['unused_images'][current_batch].append(filename)
         
         # 保存各部分内容
         if current_section == 'header':
@@ -217,8 +221,6 @@ def parse_report_file(report_path):
             result['section2'].append(line)
         elif current_section == 'section3':
             result['section3'].append(line)
-        
-        i += 1
     
     return result
 
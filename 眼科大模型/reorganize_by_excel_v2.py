@@ -17,6 +17,14 @@ from collections import defaultdict
 import re
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # 非Linux平台没有fcntl，直接走普通复制
+    fcntl = None
+
+# Linux ioctl FICLONE：在XFS/Btrfs上创建reflink（写时复制），复制只改元数据
+FICLONE = 0x40049409
+
 def find_patient_images_in_disease_folder(patient_name, search_dirs, disease_name):
     """
     在指定目录的特定疾病子文件夹中查找患者的所有图片
@@ -79,25 +87,58 @@ def get_all_disease_folders(base_dir, disease_name):
     
     return all_dirs
 
-def get_unique_filename(target_file):
+def get_unique_filename(target_file, existing_names=None, next_counters=None):
     """
     如果文件已存在，返回一个带序号的唯一文件名
+    
+    Args:
+        target_file: 目标文件路径
+        existing_names: 目标目录中已有文件名的集合（可选）。
+            提供时只在集合中查重，不再逐个调用exists()，并把选中的文件名加入集合
+        next_counters: (文件名主干, 扩展名) -> 下一个待尝试序号 的字典（可选，与existing_names配合使用）。
+            同名文件反复冲突时从上次用到的序号继续，不必每次都从 _v1 开始逐个试探
     """
-    if not target_file.exists():
+    if existing_names is None:
+        existing_names = {p.name for p in target_file.parent.iterdir()} if target_file.parent.exists() else set()
+    
+    if target_file.name not in existing_names:
+        existing_names.add(target_file.name)
         return target_file
     
     base_name = target_file.stem
     extension = target_file.suffix
     parent = target_file.parent
-    counter = 1
+    counter = next_counters.get((base_name, extension), 1) if next_counters is not None else 1
     
     while True:
         new_name = f"{base_name}_v{counter}{extension}"
-        new_file = parent / new_name
-        if not new_file.exists():
-            return new_file
+        if new_name not in existing_names:
+            existing_names.add(new_name)
+            if next_counters is not None:
+                next_counters[(base_name, extension)] = counter + 1
+            return parent / new_name
         counter += 1
 
+def fast_copy(src, dst):
+    """
+    复制单个文件并保留时间戳等元数据（替代shutil.copy2）
+
+    优先尝试FICLONE创建reflink，文件系统不支持时退回shutil.copyfile
+    （Linux下内部使用sendfile，在内核态完成复制）
+    """
+    cloned = False
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+
+    if not cloned:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
 def reorganize_by_excel(excel_path, source_base_dir, target_dir):
     """
     根据Excel文件重组数据集
@@ -398,14 +439,17 @@ def reorganize_by_excel(excel_path, source_base_dir, target_dir):
             patient_target_dir = target_path / disease / patient_folder_name / "OCT"
             patient_target_dir.mkdir(parents=True, exist_ok=True)
             
-            # 复制图片
+            # 复制图片（一次扫描目标目录，之后在内存集合中查重）
             copied_count = 0
+            with os.scandir(patient_target_dir) as it:
+                existing_names = {entry.name for entry in it}
+            next_counters = {}
             for img_path in images:
                 target_file = patient_target_dir / img_path.name
-                final_target = get_unique_filename(target_file)
+                final_target = get_unique_filename(target_file, existing_names, next_counters)
                 
                 try:
-                    shutil.copy2(img_path, final_target)
+                    fast_copy(img_path, final_target)
                     copied_count += 1
                     file_count += 1
                     # 记录已复制的图片（使用绝对路径）
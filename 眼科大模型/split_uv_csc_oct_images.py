@@ -4,11 +4,15 @@
 """
 
 import os
+import sys
 import cv2
 import numpy as np
 import argparse
 from pathlib import Path
-import shutil
+
+# 导入文件复制函数
+sys.path.append('/data2/xuhanyang/眼科大模型')
+from reorganize_by_excel_v2 import fast_copy
 
 def split_oct_image(img_path, output_dir):
     """
@@ -111,7 +115,7 @@ def process_oct_images(input_root_dir, output_root_dir=None, dry_run=False):
                 for ffa_file in os.listdir(ffa_dir):
                     src_ffa = os.path.join(ffa_dir, ffa_file)
                     dst_ffa = os.path.join(output_ffa_dir, ffa_file)
-                    shutil.copy2(src_ffa, dst_ffa)
+                    fast_copy(src_ffa, dst_ffa)
         
         # 处理OCT图像
         oct_images = [f for f in os.listdir(oct_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]